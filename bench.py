@@ -0,0 +1,237 @@
+__author__ = 'vseklecov'
+
+import base64
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import PIL.Image
+
+import db as opdsdb
+from utils import PY_PATH
+
+##########################################################################
+# Синтетическая библиотека и замер скорости сканирования.
+# Библиотека генерируется воспроизводимо (seed), затем utils.py запускается
+# в режимах -i, -s, -l (и -s -j N) на временной БД SQLite
+#
+SYLLABLES = ('ка', 'ло', 'ми', 'ра', 'то', 'ни', 'ве', 'сла', 'дор', 'ан', 'ус', 'пе', 'гри', 'ша', 'ков')
+WORDS = ('книга', 'дорога', 'время', 'город', 'ночь', 'море', 'звезда', 'тайна', 'война', 'дом', 'лес',
+         'песня', 'свет', 'тень', 'огонь', 'путь', 'край', 'сон', 'ветер', 'река')
+COVER_SIZES = ((120, 180), (300, 450), (600, 900), (1200, 1800))
+COVER_VARIANTS = 3      # вариантов обложки каждого размера
+
+FB2_TEMPLATE = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" '
+                'xmlns:l="http://www.w3.org/1999/xlink">'
+                '<description><title-info>{genres}{authors}<book-title>{title}</book-title>'
+                '<annotation><p>{annotation}</p></annotation>{cover}<lang>ru</lang>{sequence}</title-info>'
+                '<document-info><program-used>bench.py</program-used><id>{id}</id><version>1.0</version>'
+                '</document-info></description>'
+                '<body>{body}</body>{binaries}</FictionBook>')
+
+
+def word(rnd, syllables=3):
+    return ''.join(rnd.choice(SYLLABLES) for i in range(rnd.randint(2, syllables)))
+
+
+def phrase(rnd, words):
+    return ' '.join(rnd.choice(WORDS) for i in range(words))
+
+
+def makecovers(rnd):
+    """
+    Обложки JPEG разных размеров (шум, чтобы сжатие было похоже на настоящее)
+
+    """
+    covers = []
+    for size in COVER_SIZES:
+        for i in range(COVER_VARIANTS):
+            noise = size[0] // 4 * (size[1] // 4) * 3
+            image = PIL.Image.frombytes('RGB', (size[0] // 4, size[1] // 4),
+                                        rnd.getrandbits(noise * 8).to_bytes(noise, 'little'))
+            image = image.resize(size)
+            buf = io.BytesIO()
+            image.save(buf, 'JPEG', quality=85)
+            covers.append(base64.encodebytes(buf.getvalue()).decode('ascii'))
+    return covers
+
+
+class Library:
+    """
+    Генератор синтетической библиотеки: fb2 в дереве каталогов,
+    часть книг - в больших ZIP архивах, часть - в .fb2.gz
+
+    """
+    def __init__(self, root, books=1000, seed=1, body_kb=64, depth=3, zip_ratio=0.5, zip_books=500,
+                 gz_ratio=0.1, cover_ratio=0.8):
+        self.root = root
+        self.books = books
+        self.rnd = random.Random(seed)
+        self.body_kb = body_kb
+        self.depth = depth
+        self.zip_ratio = zip_ratio
+        self.zip_books = zip_books
+        self.gz_ratio = gz_ratio
+        self.cover_ratio = cover_ratio
+        self.genres = self.loadgenres()
+        self.authors = [(word(self.rnd).capitalize(), word(self.rnd, 4).capitalize() + 'ов')
+                        for i in range(max(books // 5, 1))]
+        self.covers = makecovers(self.rnd)
+        self.size = 0
+
+    @staticmethod
+    def loadgenres():
+        dbase = opdsdb.opdsDatabase('sqlite:///:memory:')
+        dbase.init_db()
+        genres = [genre for (genre,) in dbase.session.query(opdsdb.Genre.genre)]
+        dbase.close_db()
+        return genres
+
+    def book(self, n):
+        rnd = self.rnd
+        authors = ''.join('<author><first-name>{:s}</first-name><last-name>{:s}</last-name></author>'.format(*a)
+                          for a in rnd.sample(self.authors, min(rnd.randint(1, 3), len(self.authors))))
+        genres = ''.join('<genre>{:s}</genre>'.format(g) for g in rnd.sample(self.genres, rnd.randint(1, 3)))
+        paragraphs = []
+        size = 0
+        body_size = rnd.randint(self.body_kb // 2, self.body_kb * 3 // 2) * 1024
+        while size < body_size:
+            p = '<p>{:s}</p>'.format(phrase(rnd, 40))
+            paragraphs.append(p)
+            size += len(p.encode('utf-8'))
+        binaries = '<binary id="img{:d}.png" content-type="image/png">iVBORw0KGgo=</binary>'.format(n)
+        cover = ''
+        if rnd.random() < self.cover_ratio:
+            cover = '<coverpage><image l:href="#cover.jpg"/></coverpage>'
+            binaries += '<binary id="cover.jpg" content-type="image/jpeg">{:s}</binary>'.format(
+                rnd.choice(self.covers))
+        sequence = ''
+        if rnd.random() < 0.3:
+            sequence = '<sequence name="{:s}" number="{:d}"/>'.format(phrase(rnd, 2), rnd.randint(1, 10))
+        data = FB2_TEMPLATE.format(genres=genres, authors=authors, title=phrase(rnd, rnd.randint(1, 5)).capitalize(),
+                                   annotation=phrase(rnd, 30), cover=cover, sequence=sequence, id=n,
+                                   body='<section>{:s}</section>'.format(''.join(paragraphs)),
+                                   binaries=binaries).encode('utf-8')
+        self.size += len(data)
+        return data
+
+    def directory(self):
+        parts = [word(self.rnd, 2) for i in range(self.rnd.randint(1, self.depth))]
+        path = os.path.join(self.root, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def generate(self):
+        os.makedirs(self.root, exist_ok=True)
+        n = 0
+        zip_count = int(self.books * self.zip_ratio)
+        while n < zip_count:
+            count = min(self.zip_books, zip_count - n)
+            path = os.path.join(self.directory(), 'archive{:d}.zip'.format(n))
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+                for i in range(count):
+                    z.writestr('book{:d}.fb2'.format(n + i), self.book(n + i))
+            n += count
+        while n < self.books:
+            data = self.book(n)
+            if self.rnd.random() < self.gz_ratio:
+                with gzip.open(os.path.join(self.directory(), 'book{:d}.fb2.gz'.format(n)), 'wb') as f:
+                    f.write(data)
+            else:
+                with open(os.path.join(self.directory(), 'book{:d}.fb2'.format(n)), 'wb') as f:
+                    f.write(data)
+            n += 1
+
+
+def run(name, args, cfg_path, workdir):
+    """
+    Запуск utils.py; возвращает результат с временем, пиковым RSS и отчётом сканера
+
+    """
+    report_path = os.path.join(workdir, name + '.json')
+    command = [sys.executable, os.path.join(PY_PATH, 'utils.py'), '-c', cfg_path, '-p', '0', '-r', report_path]
+    started = time.time()
+    process = subprocess.Popen(command + args, stdout=subprocess.DEVNULL)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    result = {'mode': name, 'args': ' '.join(args), 'elapsed': round(time.time() - started, 3),
+              'exit_code': process.returncode,
+              'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1)}    # ru_maxrss в Кб (Linux)
+    if os.path.exists(report_path):
+        with open(report_path) as f:
+            report = json.load(f)
+        result.update(books=report['counts']['books'], books_per_sec=report['books_per_sec'],
+                      mb_per_sec=report['mb_per_sec'], times=report['times'])
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Simple OPDS benchmark - generate synthetic library and measure scanner speed.')
+    parser.add_argument('-n', '--books', help='Number of books in library', type=int, default=1000)
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+    parser.add_argument('--body-kb', help='Average book body size, Kb', type=int, default=64)
+    parser.add_argument('--depth', help='Maximum directory depth', type=int, default=3)
+    parser.add_argument('--zip-ratio', help='Part of books stored in ZIP archives', type=float, default=0.5)
+    parser.add_argument('--zip-books', help='Books in one ZIP archive', type=int, default=500)
+    parser.add_argument('--gz-ratio', help='Part of other books stored as .fb2.gz', type=float, default=0.1)
+    parser.add_argument('-j', '--jobs', help='Also run full scan with JOBS processes', type=int, default=0)
+    parser.add_argument('-d', '--dir', help='Work directory (library is reused if it exists)')
+    parser.add_argument('-o', '--output', help='Write results to JSON file')
+    args = parser.parse_args()
+
+    workdir = args.dir or tempfile.mkdtemp(prefix='sopds-bench-')
+    root = os.path.join(workdir, 'lib')
+    cfg_path = os.path.join(workdir, 'bench.conf')
+    db_path = os.path.join(workdir, 'bench.db')
+
+    if not os.path.isdir(root):
+        started = time.time()
+        library = Library(root, args.books, args.seed, args.body_kb, args.depth, args.zip_ratio, args.zip_books,
+                          args.gz_ratio)
+        library.generate()
+        print('Generated {:d} books, {:.1f} MB in {:.1f}s: {:s}'.format(args.books, library.size / 1048576,
+                                                                      time.time() - started, root))
+
+    with open(cfg_path, 'w') as f:
+        f.write('[global]\nroot_lib = {:s}\ncover_path = {:s}\ndb_name = {:s}\nformats = .fb2\n'.format(
+            root, os.path.join(workdir, 'covers'), db_path))
+
+    modes = [('init', ['-i']), ('scan-all', ['-s']), ('scan-last', ['-l'])]
+    if args.jobs > 1:
+        modes.append(('scan-all-j{:d}'.format(args.jobs), ['-s', '-j', str(args.jobs)]))
+    results = []
+    for name, mode_args in modes:
+        if name.startswith('scan-all'):
+            # полное сканирование - всегда на пустой БД
+            for path in (db_path, os.path.join(workdir, 'covers')):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            run('init', ['-i'], cfg_path, workdir)
+        result = run(name, mode_args, cfg_path, workdir)
+        result['db_size_mb'] = round(os.path.getsize(db_path) / 1048576, 2) if os.path.exists(db_path) else 0
+        results.append(result)
+        print('{:16s} {:8.2f}s  books {:6d}  {:8.1f} books/s  {:6.2f} MB/s  RSS {:7.1f} MB  DB {:7.2f} MB'.format(
+            name, result['elapsed'], result.get('books', 0), result.get('books_per_sec', 0),
+            result.get('mb_per_sec', 0), result['peak_rss_mb'], result['db_size_mb']))
+        if result['exit_code']:
+            print('{:s} failed with exit code {:d}'.format(name, result['exit_code']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'books': args.books, 'seed': args.seed, 'results': results}, f, indent=2)
+    if not args.dir:
+        shutil.rmtree(workdir)
@@ -8,10 +8,19 @@ CAT_NORMAL=0
 CAT_ZIP=1
 CAT_GZ=2
 
+BATCH_SIZE = 500    # книг в одной транзакции при пакетной загрузке
+BATCH_PARAMS = 900  # параметров в одном многострочном INSERT или IN (...) (SQLite - до 999)
+CACHE_SIZE = 100000 # записей в каждом кэше справочников (авторы, жанры, каталоги)
+PREFIX_DEPTH = 4    # длина префиксов в таблице навигации по буквам
+POOL_SIZE = 5       # соединений в пуле движка
+POOL_RECYCLE = 3600 # секунд до переоткрытия соединения из пула
+
 UNKNOWN_GENRE = 'Неизвестный жанр'
 UNKNOWN_AUTHOR = 'Неизвестный автор'
 
+import collections
 import os
+import re
 
 from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy as sql
@@ -53,6 +62,9 @@ class Book(Base):
     authors = orm.relationship('Author', secondary=book_authors, backref='books')
     genres = orm.relationship('Genre', secondary=book_genre, backref='books')
 
+    # поиск дубликатов (finddouble)
+    sql.Index('ix_books_double', title, format, filesize, doublicat)
+
     def __init__(self, file_name='fn', path='/', cat_id=0, format_book='fb2', title='title', lang='ru',
                  size=0, archive=0, doublicat=0, annotation=''):
         self.filename = file_name
@@ -73,6 +85,9 @@ class Book(Base):
     def cat_zip(self):
         return self.cat_type == CAT_ZIP
 
+    def cat_gz(self):
+        return self.cat_type == CAT_GZ
+
     def __repr__(self):
         return "<Book('%s','%s')>" % (self.title, ','.join(self.authors))
 
@@ -136,6 +151,231 @@ class Genre(Base):
         return "<Genre(%s)>" % self.subsection
 
 
+class FileState(Base):
+    __tablename__ = 'filestate'
+
+    path = sql.Column(sql.String(1024), primary_key=True)
+    size = sql.Column(sql.BigInteger, nullable=False, default=0)
+    mtime = sql.Column(sql.BigInteger, nullable=False, default=0)    # st_mtime_ns
+    inode = sql.Column(sql.BigInteger, nullable=False, default=0)
+    digest = sql.Column(sql.String(40))     # для ZIP - контрольная сумма центрального каталога
+
+    def __init__(self, path, size=0, mtime=0, inode=0, digest=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.digest = digest
+
+    def __repr__(self):
+        return "<FileState('%s')>" % self.path
+
+
+class ZipMember(Base):
+    __tablename__ = 'zipmembers'
+
+    path = sql.Column(sql.String(1024), primary_key=True)
+    name = sql.Column(sql.String(256), primary_key=True)
+    crc = sql.Column(sql.BigInteger, nullable=False, default=0)
+    size = sql.Column(sql.BigInteger, nullable=False, default=0)
+
+    def __init__(self, path, name, crc=0, size=0):
+        self.path = path
+        self.name = name
+        self.crc = crc
+        self.size = size
+
+    def __repr__(self):
+        return "<ZipMember('%s','%s')>" % (self.path, self.name)
+
+
+class Checkpoint(Base):
+    __tablename__ = 'checkpoints'
+
+    scan = sql.Column(sql.String(16), primary_key=True)
+    path = sql.Column(sql.String(1024), nullable=False, default='')   # последний файл или архив
+    member = sql.Column(sql.String(256), nullable=False, default='')  # последняя записанная книга архива
+
+    def __init__(self, scan, path='', member=''):
+        self.scan = scan
+        self.path = path
+        self.member = member
+
+    def __repr__(self):
+        return "<Checkpoint('%s','%s','%s')>" % (self.scan, self.path, self.member)
+
+
+class Counter(Base):
+    __tablename__ = 'counters'
+
+    name = sql.Column(sql.String(16), primary_key=True)   # books, books_nodup, authors, catalogs, genre
+    key = sql.Column(sql.Integer, primary_key=True, default=0)  # genre_id для счётчиков жанров
+    value = sql.Column(sql.Integer, nullable=False, default=0)
+
+    def __init__(self, name, key=0, value=0):
+        self.name = name
+        self.key = key
+        self.value = value
+
+    def __repr__(self):
+        return "<Counter('%s','%s','%s')>" % (self.name, self.key, self.value)
+
+
+class Prefix(Base):
+    __tablename__ = 'prefixes'
+
+    kind = sql.Column(sql.String(16), primary_key=True)     # author, title, title_nodup
+    parent = sql.Column(sql.String(16), primary_key=True)   # префикс на символ короче, в нижнем регистре
+    prefix = sql.Column(sql.String(16), primary_key=True)
+    value = sql.Column(sql.Integer, nullable=False, default=0)
+
+    def __init__(self, kind, parent, prefix, value=0):
+        self.kind = kind
+        self.parent = parent
+        self.prefix = prefix
+        self.value = value
+
+    def __repr__(self):
+        return "<Prefix('%s','%s','%s')>" % (self.kind, self.prefix, self.value)
+
+
+class BookHash(Base):
+    __tablename__ = 'bookhashes'
+
+    book_id = sql.Column(sql.Integer, sql.ForeignKey('books.book_id'), primary_key=True)
+    hash = sql.Column(sql.String(40), nullable=False, index=True)   # blake2b содержимого файла книги
+
+    book = orm.relationship('Book')
+
+    def __init__(self, book, hash):
+        self.book = book
+        self.hash = hash
+
+    def __repr__(self):
+        return "<BookHash('%s')>" % self.hash
+
+
+def keyset(columns, cursor, backward=False):
+    """
+    Условие "строка после (до) курсора" для сортировки по columns:
+    (a, b, c) > (x, y, z) раскрывается в a > x OR a = x AND b > y OR a = x AND b = y AND c > z
+
+    """
+    clauses = []
+    for i, column in enumerate(columns):
+        condition = column < cursor[i] if backward else column > cursor[i]
+        clauses.append(sql.and_(*[c == v for c, v in zip(columns[:i], cursor[:i])] + [condition]))
+    return sql.or_(*clauses)
+
+
+def validcursor(cursor, columns):
+    """
+    Курсор из запроса клиента: значения по числу columns и только простых типов, иначе None
+
+    """
+    if cursor is None or len(cursor) != len(columns):
+        return None
+    if all(value is None or type(value) in (str, int, float) for value in cursor):
+        return tuple(cursor)
+    return None
+
+
+##########################################################################
+# Полнотекстовый поиск (SQLite FTS5): rowid = book_id, таблица не входит
+# в Base.metadata и создаётся отдельно, если FTS5 доступен
+#
+books_fts = sql.Table('books_fts', sql.MetaData(),
+                      sql.Column('rowid', sql.Integer, primary_key=True),
+                      sql.Column('title', sql.String),
+                      sql.Column('authors', sql.String),
+                      sql.Column('annotation', sql.String),
+                      sql.Column('books_fts', sql.String),   # скрытая колонка для MATCH по всем колонкам
+                      sql.Column('rank', sql.Float))
+
+FTS_DDL = ("CREATE VIRTUAL TABLE books_fts USING fts5(title, authors, annotation, "
+           "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+
+
+def matchquery(term):
+    """
+    Запрос FTS5 из строки поиска: каждое слово - префикс, все слова обязательны
+
+    """
+    return ' '.join('"{:s}"*'.format(word) for word in re.findall(r'\w+', term))
+
+
+def prefixes(text):
+    """
+    Пары (родитель, префикс) строки text длиной до PREFIX_DEPTH символов. Строка короче
+    PREFIX_DEPTH попадает и в подсписок самой себя - так же, как substr() в GROUP BY.
+
+    """
+    return [(text[:k-1].lower(), text[:k]) for k in range(1, min(len(text) + 1, PREFIX_DEPTH) + 1)]
+
+
+def startswith(column, letters):
+    # диапазон вместо LIKE - чтобы работал индекс
+    return sql.and_(column >= letters, column < letters + '\U0010ffff')
+
+
+class Page:
+    """
+    Страница выборки: строки (items), признак следующей страницы и курсоры соседних страниц
+    (None - страницы нет). Ведёт себя как список строк.
+
+    """
+    def __init__(self, items=(), has_next=False, next_cursor=None, prev_cursor=None):
+        self.items = list(items)
+        self.has_next = has_next
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __repr__(self):
+        return "<Page(%d,%s)>" % (len(self.items), self.has_next)
+
+
+class LookupCache:
+    """
+    Ограниченный LRU-кэш "ключ поиска -> id" для справочных таблиц.
+    complete - в кэше все строки таблицы, т.е. промах означает, что в БД такой записи нет.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.complete = False
+
+    def load(self, rows):
+        for key, value in rows:
+            if len(self.data) >= self.size:
+                self.complete = False
+                return
+            self.data[key] = value
+        self.complete = True
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.complete = False
+
+
 class opdsDatabase:
     def __init__(self, iname='sqlite:///:memory:', iuser='', ipass='', ihost='localhost', iroot_lib='..'):
         self.db_name = iname
@@ -147,14 +387,31 @@ class opdsDatabase:
         self.errcode = 0
         self.err = ''
         self.is_open = False
-        self.next_page = False
 
-    def open_db(self):
+        self.batch_size = 0
+        self.batch_books = 0
+        self.batch_bauthors = set()
+        self.batch_bgenres = set()
+        self.batch_filestates = []
+        self.batch_zipmembers = []
+        self.batch_checkpoints = {}
+        self.flush_hooks = []   # вызываются перед фиксацией пакета
+        self.batch_counters = collections.Counter()   # (имя, ключ) -> изменение счётчика
+        self.batch_prefixes = collections.Counter()   # (вид, родитель, префикс) -> изменение
+        self.batch_search = set()   # book_id книг для переиндексации в books_fts
+        self.search_ready = None
+        self.counters_ready = None
+
+        self.author_cache = None
+        self.genre_cache = None
+        self.cat_cache = None
+
+    def open_db(self, pool_size=POOL_SIZE):
         if not self.is_open:
             try:
-                self.engine = sql.create_engine(self.db_name)
-                Session = orm.sessionmaker(bind=self.engine)
-                self.session = Session()
+                self.engine = sql.create_engine(self.db_name, **self.engine_options(pool_size))
+                # своя сессия у каждого потока; release() закрывает сессию текущего потока
+                self.session = orm.scoped_session(orm.sessionmaker(bind=self.engine))
             except:
                 self.err = ''
                 self.errcode = 1
@@ -164,9 +421,28 @@ class opdsDatabase:
             self.errcode = 1
             self.err = 'Error open database. Database already open.'
 
+    def engine_options(self, pool_size):
+        url = sql.engine.url.make_url(self.db_name)
+        if url.drivername.startswith('sqlite'):
+            if url.database in (None, '', ':memory:'):
+                return {}   # БД в памяти живёт в своём единственном соединении
+            # файл SQLite: пул соединений, которые можно отдавать разным потокам
+            return {'poolclass': sql.pool.QueuePool, 'pool_size': pool_size,
+                    'connect_args': {'check_same_thread': False}}
+        return {'pool_size': pool_size, 'pool_recycle': POOL_RECYCLE}
+
+    def release(self):
+        """
+        Конец запроса: сессия текущего потока закрывается, соединение возвращается в пул
+
+        """
+        self.session.remove()
+
     def close_db(self):
         if self.is_open:
-            self.session.close()
+            if self.batch_size:
+                self.end_batch()
+            self.session.remove()
             self.is_open = False
         else:
             self.errcode = 5
@@ -182,33 +458,290 @@ class opdsDatabase:
         self.err = ''
         self.errcode = 0
 
+    ##########################################################################
+    # Пакетная загрузка: книги накапливаются в сессии, связи с авторами и
+    # жанрами - в памяти, и всё записывается одной транзакцией на batch_size книг
+    #
+    def begin_batch(self, batch_size=BATCH_SIZE):
+        self.flush_batch()
+        self.batch_size = batch_size
+
+    def end_batch(self):
+        self.flush_batch()
+        self.batch_size = 0
+
+    def flush_batch(self):
+        for hook in self.flush_hooks:
+            hook()
+        if self.batch_bauthors:
+            rows = [{'author_id': author_id, 'book_id': book_id} for (book_id, author_id) in self.batch_bauthors]
+            self.insert_rows(book_authors, rows)
+            self.batch_bauthors.clear()
+        if self.batch_bgenres:
+            rows = [{'genre_id': genre_id, 'book_id': book_id} for (book_id, genre_id) in self.batch_bgenres]
+            self.insert_rows(book_genre, rows)
+            for (book_id, genre_id) in self.batch_bgenres:
+                self.count('genre', genre_id)
+            self.batch_bgenres.clear()
+        if self.batch_filestates:
+            self.insert_rows(FileState.__table__, self.batch_filestates)
+            self.batch_filestates = []
+        if self.batch_zipmembers:
+            self.insert_rows(ZipMember.__table__, self.batch_zipmembers)
+            self.batch_zipmembers = []
+        # отметка о ходе сканирования фиксируется вместе с записанными до неё книгами
+        for scan, (path, member) in self.batch_checkpoints.items():
+            self.session.merge(Checkpoint(scan, path, member))
+        self.batch_checkpoints.clear()
+        self.writecounters()
+        self.writesearch()
+        self.batch_books = 0
+        self.session.commit()
+
+    def insert_rows(self, table, rows):
+        if not rows:
+            return
+        count = max(1, BATCH_PARAMS // len(rows[0]))
+        for i in range(0, len(rows), count):
+            self.session.execute(table.insert().values(rows[i:i+count]))
+
+    ##########################################################################
+    # Счётчики для главного меню и списка жанров: изменения копятся в памяти и
+    # записываются в той же транзакции, что и сами данные
+    #
+    def count(self, name, key=0, delta=1):
+        self.batch_counters[(name, key)] += delta
+
+    def countprefixes(self, kind, text, delta=1):
+        for key in prefixes(text or ''):
+            self.batch_prefixes[(kind,) + key] += delta
+
+    def countbook(self, title, doublicat, delta=1):
+        self.count('books', 0, delta)
+        self.countprefixes('title', title, delta)
+        if doublicat == 0:
+            self.count('books_nodup', 0, delta)
+            self.countprefixes('title_nodup', title, delta)
+
+    def countersready(self):
+        # признак полного пересчёта - счётчик prefixes с текущей глубиной префиксов
+        if self.counters_ready is None:
+            self.counters_ready = self.session.query(Counter.value). \
+                filter(Counter.name == 'prefixes', Counter.key == 0).scalar() == PREFIX_DEPTH
+        return self.counters_ready
+
+    def writecounters(self):
+        # в БД без счётчиков изменения не пишутся: счётчики будут пересчитаны целиком при первом чтении
+        if (self.batch_counters or self.batch_prefixes) and self.countersready():
+            self.adddeltas(Counter.__table__, ('name', 'key'), self.batch_counters)
+            self.adddeltas(Prefix.__table__, ('kind', 'parent', 'prefix'), self.batch_prefixes)
+        self.batch_counters.clear()
+        self.batch_prefixes.clear()
+
+    def adddeltas(self, table, columns, deltas):
+        """
+        Прибавляет изменения deltas {значения columns: изменение} к колонке value:
+        существующие строки - одним UPDATE на все, новые - многострочным INSERT
+
+        """
+        deltas = {key: delta for (key, delta) in deltas.items() if delta}
+        if not deltas:
+            return
+        keys = [table.c[column] for column in columns]
+        values = list({key[-1] for key in deltas})
+        existing = set()
+        for i in range(0, len(values), BATCH_PARAMS):
+            existing.update(tuple(row) for row in
+                            self.session.execute(sql.select(keys).where(keys[-1].in_(values[i:i+BATCH_PARAMS]))))
+        query = table.update().where(sql.and_(*[key == sql.bindparam('_' + column)
+                                                for (key, column) in zip(keys, columns)])). \
+            values(value=table.c.value + sql.bindparam('_delta'))
+        rows = [dict(zip(['_' + column for column in columns], key), _delta=delta)
+                for (key, delta) in deltas.items() if key in existing]
+        if rows:
+            self.session.execute(query, rows)
+        self.insert_rows(table, [dict(zip(columns, key), value=delta)
+                                 for (key, delta) in deltas.items() if key not in existing])
+
+    def rebuildcounters(self):
+        """
+        Полный пересчёт счётчиков по данным БД (восстановление, обновление старой БД)
+
+        """
+        if self.batch_size:
+            self.flush_batch()
+        self.batch_counters.clear()
+        self.batch_prefixes.clear()
+        rows = [{'name': 'prefixes', 'key': 0, 'value': PREFIX_DEPTH},
+                {'name': 'books', 'key': 0, 'value': self.session.query(sql.func.count(Book.book_id)).scalar()},
+                {'name': 'books_nodup', 'key': 0,
+                 'value': self.session.query(sql.func.count(Book.book_id)).filter(Book.doublicat == 0).scalar()},
+                {'name': 'authors', 'key': 0, 'value': self.session.query(sql.func.count(Author.author_id)).scalar()},
+                {'name': 'catalogs', 'key': 0, 'value': self.session.query(sql.func.count(Catalog.cat_id)).scalar()}]
+        rows.extend({'name': 'genre', 'key': genre_id, 'value': cnt} for (genre_id, cnt) in
+                    self.session.query(book_genre.c.genre_id, sql.func.count(book_genre.c.book_id)).
+                    group_by(book_genre.c.genre_id))
+        self.session.query(Counter).delete(synchronize_session=False)
+        self.insert_rows(Counter.__table__, rows)
+        counts = collections.Counter()
+        for (search_name,) in self.session.query(Author.search_name):
+            counts.update(('author',) + key for key in prefixes(search_name or ''))
+        for (title, doublicat) in self.session.query(Book.title, Book.doublicat):
+            keys = prefixes(title or '')
+            counts.update(('title',) + key for key in keys)
+            if doublicat == 0:
+                counts.update(('title_nodup',) + key for key in keys)
+        self.session.query(Prefix).delete(synchronize_session=False)
+        self.insert_rows(Prefix.__table__, [{'kind': kind, 'parent': parent, 'prefix': prefix, 'value': value}
+                                            for ((kind, parent, prefix), value) in counts.items()])
+        self.session.commit()
+        self.counters_ready = True
+
+    def getcounters(self, name):
+        if not self.countersready():
+            self.rebuildcounters()
+        return {key: value for (key, value) in
+                self.session.query(Counter.key, Counter.value).filter(Counter.name == name)}
+
+    ##########################################################################
+    # Кэши справочников на время сканирования: id авторов, жанров и каталогов
+    # берутся из памяти, в БД обращаемся только при промахе
+    #
+    def load_cache(self, cache_size=CACHE_SIZE):
+        self.author_cache = LookupCache(cache_size)
+        self.author_cache.load(self.session.query(Author.search_name, Author.author_id).limit(cache_size + 1))
+        self.genre_cache = LookupCache(cache_size)
+        self.genre_cache.load((genre.lower(), genre_id) for (genre, genre_id) in
+                              self.session.query(Genre.genre, Genre.genre_id).limit(cache_size + 1))
+        self.cat_cache = LookupCache(cache_size)
+        self.cat_cache.load(self.session.query(Catalog.path, Catalog.cat_id).limit(cache_size + 1))
+
+    def clear_cache(self):
+        self.author_cache = None
+        self.genre_cache = None
+        self.cat_cache = None
+
+    def getauthor_id(self, first_name, last_name):
+        if self.author_cache is None:
+            return self.addauthor(first_name, last_name).author_id
+        search_name = last_name.lower()+' '+first_name.lower()
+        author_id = self.author_cache.get(search_name)
+        if author_id is None:
+            author = None if self.author_cache.complete else self.findauthor(first_name, last_name)
+            if not author:
+                author = Author(last_name, first_name)
+                self.session.add(author)
+                self.count('authors')
+                self.countprefixes('author', author.search_name)
+                self.commit()
+            author_id = author.author_id
+            self.author_cache.put(search_name, author_id)
+        return author_id
+
+    def getgenre_id(self, genre):
+        if self.genre_cache is None:
+            return self.addgenre(genre).genre_id
+        genre_id = self.genre_cache.get(genre)
+        if genre_id is None:
+            _genre = None if self.genre_cache.complete else self.findgenre(genre)
+            if not _genre:
+                _genre = Genre(genre, UNKNOWN_GENRE, genre)
+                self.session.add(_genre)
+                self.commit()
+            genre_id = _genre.genre_id
+            self.genre_cache.put(genre, genre_id)
+        return genre_id
+
+    def commit(self):
+        if self.batch_size:
+            self.session.flush()
+        else:
+            self.writecounters()
+            self.writesearch()
+            self.session.commit()
+
 
     def findbook(self, filename, path):
         return self.session.query(Book).filter(Book.filename == filename,
                                                Book.path == path).order_by(Book.book_id).first()
 
-    def finddouble(self, title, format_book, file_size):
-        book = self.session.query(Book). \
-            filter(Book.title == title, Book.format == format_book, Book.filesize == file_size, Book.doublicat == 0). \
-            order_by(Book.book_id).first()
+    def finddouble(self, title, format_book, file_size, filehash=None):
+        """
+        Поиск оригинала для новой книги: по хэшу содержимого, если он есть,
+        иначе по совпадению названия, формата и размера файла.
+
+        """
+        if filehash:
+            query = self.session.query(Book.book_id).join(BookHash, BookHash.book_id == Book.book_id). \
+                filter(BookHash.hash == filehash, Book.doublicat == 0)
+        else:
+            query = self.session.query(Book.book_id). \
+                filter(Book.title == title, Book.format == format_book, Book.filesize == file_size,
+                       Book.doublicat == 0)
+        book = query.order_by(Book.book_id).first()
         if not book:
             book_id = 0
         else:
             book_id = book.book_id
         return book_id
 
-    def addbook(self, name, path, cat_id, exten, title, lang, size=0, archive=0, doublicates=0, annotation=''):
+    def rededup(self, by_hash=False):
+        """
+        Пересчёт признака doublicat для всей библиотеки за один проход по книгам
+        в порядке добавления. Возвращает число изменённых книг.
+
+        """
+        if self.batch_size:
+            self.flush_batch()
+        query = self.session.query(Book.book_id, Book.title, Book.format, Book.filesize, Book.doublicat)
+        if by_hash:
+            query = query.add_columns(BookHash.hash).outerjoin(BookHash, BookHash.book_id == Book.book_id)
+        originals = {}
+        changed = []
+        for row in query.order_by(Book.book_id):
+            if by_hash and row.hash:
+                key = (row.hash,)
+            else:
+                key = (row.title, row.format, row.filesize)
+            doublicat = originals.setdefault(key, row.book_id)
+            if doublicat == row.book_id:
+                doublicat = 0
+            if doublicat != row.doublicat:
+                changed.append({'_book_id': row.book_id, '_doublicat': doublicat})
+                if not doublicat or not row.doublicat:
+                    self.count('books_nodup', 0, -1 if row.doublicat == 0 else 1)
+                    self.countprefixes('title_nodup', row.title, -1 if row.doublicat == 0 else 1)
+        table = Book.__table__
+        query = table.update().where(table.c.book_id == sql.bindparam('_book_id')). \
+            values(doublicat=sql.bindparam('_doublicat'))
+        for i in range(0, len(changed), BATCH_SIZE):
+            self.session.execute(query, changed[i:i+BATCH_SIZE])
+        self.writecounters()
+        self.session.commit()
+        return len(changed)
+
+    def addbook(self, name, path, cat_id, exten, title, lang, size=0, archive=0, doublicates=0, annotation='',
+                filehash=None):
         book = self.findbook(name, path)
         if book:
             return book
+        if self.batch_size and self.batch_books >= self.batch_size:
+            self.flush_batch()
         format_book = exten[1:].lower()
         if doublicates != 0:
-            doublicat = self.finddouble(title, format_book, size)
+            doublicat = self.finddouble(title, format_book, size, filehash)
         else:
             doublicat = 0
         book = Book(name, path, cat_id, format_book, title, lang, size, archive, doublicat, annotation)
         self.session.add(book)
-        self.session.commit()
+        self.countbook(title, doublicat)
+        if filehash:
+            self.session.add(BookHash(book, filehash))
+        self.session.flush()
+        self.batch_search.add(book.book_id)
+        self.commit()
+        if self.batch_size:
+            self.batch_books += 1
         return book
 
     def addcover(self, book_id, fn, cover_type):
@@ -217,7 +750,21 @@ class opdsDatabase:
             return
         book.cover = fn
         book.cover_type = cover_type
-        self.session.commit()
+        self.commit()
+
+    def addcovers(self, covers):
+        """
+        Пакетная запись обложек: covers - список (book_id, имя файла, тип)
+
+        """
+        if not covers:
+            return
+        table = Book.__table__
+        query = table.update().where(table.c.book_id == sql.bindparam('_book_id')). \
+            values(cover=sql.bindparam('_cover'), cover_type=sql.bindparam('_cover_type'))
+        self.session.execute(query, [{'_book_id': book_id, '_cover': fn, '_cover_type': cover_type}
+                                     for (book_id, fn, cover_type) in covers])
+        self.commit()
 
     def findauthor(self, first_name, last_name):
         search_name = last_name.lower()+' '+first_name.lower()
@@ -238,16 +785,23 @@ class opdsDatabase:
             return author
         author = Author(last_name, first_name)
         self.session.add(author)
-        self.session.commit()
+        self.count('authors')
+        self.countprefixes('author', author.search_name)
+        self.commit()
         return author
 
     def addbauthor(self, book_id, author_id):
+        if self.batch_size:
+            self.batch_bauthors.add((book_id, author_id))
+            self.batch_search.add(book_id)
+            return
         book = self.session.query(Book).get(book_id)
         author = self.session.query(Author).get(author_id)
         if not book or not author:
             return
         book.authors.append(author)
-        self.session.commit()
+        self.batch_search.add(book_id)
+        self.commit()
 
     def findgenre(self, genre):
         return self.session.query(Genre).filter(sql.func.lower(Genre.genre) == genre).first()
@@ -265,16 +819,20 @@ class opdsDatabase:
         if not _genre:
             _genre = Genre(genre, UNKNOWN_GENRE, genre)
             self.session.add(_genre)
-            self.session.commit()
+            self.commit()
         return _genre
 
     def addbgenre(self, book_id, genre_id):
+        if self.batch_size:
+            self.batch_bgenres.add((book_id, genre_id))
+            return
         book = self.session.query(Book).get(book_id)
         genre = self.session.query(Genre).get(genre_id)
         if not book or not genre:
             return
         book.genres.append(genre)
-        self.session.commit()
+        self.count('genre', genre_id)
+        self.commit()
 
     def findcat(self, catalog):
         (head, tail) = os.path.split(catalog)
@@ -288,7 +846,14 @@ class opdsDatabase:
         return cat_id
 
     def addcattree(self, catalog, archive=0):
-        cat_id = self.findcat(catalog)
+        if self.cat_cache is None:
+            cat_id = self.findcat(catalog)
+        else:
+            cat_id = self.cat_cache.get(catalog)
+            if cat_id is None:
+                cat_id = 0 if self.cat_cache.complete else self.findcat(catalog)
+                if cat_id != 0:
+                    self.cat_cache.put(catalog, cat_id)
         if cat_id != 0:
             return cat_id
         if catalog == '' or catalog == '.' or catalog == '..':
@@ -300,7 +865,10 @@ class opdsDatabase:
             parent_id = self.addcattree(head)
         _catalog = Catalog(parent_id, tail, catalog, archive)
         self.session.add(_catalog)
-        self.session.commit()
+        self.count('catalogs')
+        self.commit()
+        if self.cat_cache is not None:
+            self.cat_cache.put(catalog, _catalog.cat_id)
         return _catalog.cat_id
 
     def getcatinparent(self, parent_id, limit=0, page=0):
@@ -325,20 +893,140 @@ class opdsDatabase:
             rows = query[offset:(offset+limit)]
         return rows
 
-    def getitemsincat(self, cat_id, limit=0, page=0):
-        query1 = self.session.query(sql.sql.expression.literal_column('1').label('cat'), Catalog.cat_id, Catalog.cat_name, Catalog.path, sql.func.now(),
-                                    Catalog.cat_name.label('title')).filter(Catalog.parent_id == cat_id)
-        query2 = self.session.query(sql.sql.expression.literal_column('2'), Book.book_id, Book.filename, Book.path, Book.registerdate,
-                                    Book.title).filter(Book.cat_id == cat_id)
+    ##########################################################################
+    # Полнотекстовый поиск: книги, изменённые в транзакции, переиндексируются
+    # при её фиксации (после записи связей с авторами)
+    #
+    def searchready(self):
+        if self.search_ready is None:
+            self.search_ready = self.engine.dialect.name == 'sqlite' and self.engine.has_table(books_fts.name)
+        return self.search_ready
+
+    def createsearch(self):
+        """
+        Создание индекса books_fts (только SQLite с FTS5) и заполнение его по всем книгам
+
+        """
+        if self.engine.dialect.name != 'sqlite' or self.engine.has_table(books_fts.name):
+            return
+        try:
+            self.engine.execute(FTS_DDL)
+        except sql.exc.OperationalError:
+            self.search_ready = False   # SQLite без FTS5 - поиск через LIKE
+            return
+        self.search_ready = True
+        self.rebuildsearch()
+
+    def writesearch(self, book_ids=None):
+        book_ids = list(self.batch_search if book_ids is None else book_ids)
+        self.batch_search.clear()
+        if not book_ids or not self.searchready():
+            return
+        for i in range(0, len(book_ids), BATCH_PARAMS):
+            ids = book_ids[i:i+BATCH_PARAMS]
+            authors = collections.defaultdict(list)
+            for (book_id, first_name, last_name) in self.session.query(book_authors.c.book_id, Author.first_name,
+                                                                       Author.last_name). \
+                    filter(Author.author_id == book_authors.c.author_id, book_authors.c.book_id.in_(ids)):
+                authors[book_id].append('{:s} {:s}'.format(first_name or '', last_name or '').strip())
+            rows = [{'rowid': book_id, 'title': title or '', 'authors': ' '.join(authors[book_id]),
+                     'annotation': annotation or ''}
+                    for (book_id, title, annotation) in
+                    self.session.query(Book.book_id, Book.title, Book.annotation).filter(Book.book_id.in_(ids))]
+            self.session.execute(books_fts.delete().where(books_fts.c.rowid.in_(ids)))
+            self.insert_rows(books_fts, rows)
+
+    def rebuildsearch(self):
+        if self.batch_size:
+            self.flush_batch()
+        if not self.searchready():
+            return
+        self.session.execute(books_fts.delete())
+        book_ids = [book_id for (book_id,) in self.session.query(Book.book_id)]
+        for i in range(0, len(book_ids), BATCH_SIZE):
+            self.writesearch(book_ids[i:i+BATCH_SIZE])
+        self.session.commit()
+
+    def searchbooks(self, term, limit=0, page=0, doublicates=True, after=None, before=None):
+        """
+        Поиск книг по словам из названия, авторов и аннотации (префиксный, по релевантности).
+        Без FTS5 - поиск подстроки в названии.
+
+        """
+        if not self.searchready():
+            return self.getbooksfortitle('%' + term, limit, page, doublicates, after, before)
+        query = matchquery(term)
+        if not query:
+            return Page()
+        query = self.bookquery(books_fts.c.rank).join(books_fts, books_fts.c.rowid == Book.book_id). \
+            filter(books_fts.c.books_fts.match(query))
+        if not doublicates:
+            query = query.filter(Book.doublicat == 0)
+        rows = self.getpage(query, (books_fts.c.rank, Book.book_id), lambda row: (row[1], row[0].book_id),
+                            limit, page, after, before)
+        return Page([book for (book, rank) in rows], rows.has_next, rows.next_cursor, rows.prev_cursor)
+
+    def getpage(self, query, columns, key, limit=0, page=0, after=None, before=None):
+        """
+        Постраничная выборка с сортировкой по columns (последний - первичный ключ).
+        after/before - курсор (значения columns) строки, после (до) которой начинается страница;
+        без курсора используется номер страницы page (смещение).
+        Наличие следующей страницы определяется по limit+1 строке, без count().
+        key(row) - курсор строки. Возвращает Page.
+        Курсор неверной длины или с неподходящими значениями не учитывается.
+
+        """
+        after = validcursor(after, columns)
+        before = validcursor(before, columns)
+        if before is not None:
+            query = query.filter(keyset(columns, before, True)).order_by(*[c.desc() for c in columns])
+        else:
+            if after is not None:
+                query = query.filter(keyset(columns, after))
+            query = query.order_by(*columns)
         if limit == 0:
-            rows = query1.union(query2).order_by('1', '6').all()
-            self.next_page = False
+            rows = query.all()
+            more = False
         else:
-            found_rows = query1.union(query2).count()
-            offset = limit * page
-            rows = query1.union(query2).order_by('1', '6')[offset:(offset+limit)]
-            self.next_page = (found_rows > (offset+limit))
-        return rows
+            offset = limit * page if after is None and before is None else 0
+            rows = query[offset:(offset+limit+1)]
+            more = len(rows) > limit
+            rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+            has_next = True
+            has_prev = more
+        else:
+            has_next = more
+            has_prev = after is not None or (limit and page > 0)
+        return Page(rows, has_next, key(rows[-1]) if rows and has_next else None,
+                    key(rows[0]) if rows and has_prev else None)
+
+    def getitemsincat(self, cat_id, limit=0, page=0, after=None, before=None):
+        query1 = self.session.query(sql.sql.expression.literal_column('1').label('cat'),
+                                    Catalog.cat_id.label('item_id'), Catalog.cat_name.label('name'),
+                                    Catalog.path.label('path'), sql.func.now().label('date'),
+                                    Catalog.cat_name.label('title')).filter(Catalog.parent_id == cat_id)
+        query2 = self.session.query(sql.sql.expression.literal_column('2'), Book.book_id, Book.filename, Book.path,
+                                    Book.registerdate, Book.title).filter(Book.cat_id == cat_id)
+        items = sql.union(query1.statement, query2.statement).alias('items')
+        rows = self.getpage(self.session.query(items), (items.c.cat, items.c.title, items.c.item_id),
+                            lambda row: (row.cat, row.title, row.item_id), limit, page, after, before)
+        # книги страницы - одним запросом, последним элементом строки (для каталогов - None)
+        book_ids = [row.item_id for row in rows if row.cat == 2]
+        books = {book.book_id: book for book in self.bookquery().filter(Book.book_id.in_(book_ids))} \
+            if book_ids else {}
+        return Page([tuple(row) + (books.get(row.item_id) if row.cat == 2 else None,) for row in rows],
+                    rows.has_next, rows.next_cursor, rows.prev_cursor)
+
+    def bookquery(self, *entities):
+        """
+        Запрос книг для выдачи в каталог: авторы и жанры загружаются сразу для всей
+        выборки (по одному запросу IN на связь), а не отдельно для каждой книги
+
+        """
+        return self.session.query(Book, *entities).options(orm.selectinload(Book.authors),
+                                                           orm.selectinload(Book.genres))
 
     def getbook(self, book_id):
         return self.session.query(Book).get(book_id)
@@ -357,72 +1045,67 @@ class opdsDatabase:
         rows = [(genre.section, genre.subsection) for genre in book.genres]
         return rows
 
+    def getprefixes(self, kind, letters):
+        """
+        Следующие за letters префиксы и число строк с ними - из таблицы prefixes
+
+        """
+        if not self.countersready():
+            self.rebuildcounters()
+        query = self.session.query(Prefix.prefix, Prefix.value). \
+            filter(Prefix.kind == kind, Prefix.parent == letters, Prefix.value > 0).order_by(Prefix.prefix)
+        return query.all()
+
     def getauthor_2letters(self, letters):
+        letters = letters.lower()
+        if len(letters) < PREFIX_DEPTH:
+            return self.getprefixes('author', letters)
         lc = len(letters) + 1
-        query = self.session.query(sql.func.substr(Author.search_name, 1, lc).label('letters'),
-                                   sql.func.count('*').label('cnt')).\
-            filter(Author.search_name.like(letters.lower()+'%')).group_by('1').order_by('1')
+        column = sql.func.substr(Author.search_name, 1, lc)
+        query = self.session.query(column.label('letters'), sql.func.count('*').label('cnt')).\
+            filter(startswith(Author.search_name, letters)).group_by(column).order_by(column)
         return query.all()
 
     def gettitle_2letters(self, letters, doublicates=True):
+        letters = letters.lower()
+        if len(letters) < PREFIX_DEPTH:
+            return self.getprefixes('title' if doublicates else 'title_nodup', letters)
         lc = len(letters) + 1
-        query = self.session.query(sql.func.substr(Book.title, 1, lc).label('letters'),
-                                   sql.func.count('*').label('cnt')).\
-            filter(Book.search_title.like(letters.lower()+'%'))
+        column = sql.func.substr(Book.title, 1, lc)
+        query = self.session.query(column.label('letters'), sql.func.count('*').label('cnt')).\
+            filter(startswith(Book.search_title, letters))
         if not doublicates:
             query = query.filter(Book.doublicat == 0)
-        query = query.group_by('1').order_by('1')
+        query = query.group_by(column).order_by(column)
         return query.all()
 
-    def getbooksfortitle(self, letters, limit=0, page=0, doublicates=True):
-        query = self.session.query(Book).filter(Book.title.like(letters + '%'))
+    def getbooksfortitle(self, letters, limit=0, page=0, doublicates=True, after=None, before=None):
+        query = self.bookquery().filter(Book.title.like(letters + '%'))
         if not doublicates:
             query = query.filter(Book.doublicat == 0)
-        if limit == 0:
-            books = query.all()
-            self.next_page = False
-        else:
-            found_rows = query.count()
-            offset = limit * page
-            books = query[offset:(offset+limit)]
-            self.next_page = (found_rows > (offset+limit))
-        return books
+        return self.getpage(query, (Book.title, Book.book_id), lambda book: (book.title, book.book_id),
+                            limit, page, after, before)
 
-    def getauthorsbyl(self, letters, limit=0, page=0, doublicates=True):
+    def getauthorsbyl(self, letters, limit=0, page=0, doublicates=True, after=None, before=None):
         query = self.session.query(Author.author_id, Author.first_name, Author.last_name,
-                                   sql.func.count(book_authors)).filter(Author.author_id == book_authors.c.author_id,
-                                                                        Author.search_name.like(letters.lower()+'%'))
+                                   sql.func.count(book_authors.c.book_id), Author.search_name).\
+            filter(Author.author_id == book_authors.c.author_id, Author.search_name.like(letters.lower()+'%'))
         if not doublicates:
             query = query.filter(book_authors.c.book_id == Book.book_id, Book.doublicat == 0)
-        query = query.group_by('1', '2', '3')
-        query = query.order_by(Author.search_name)
-        if limit == 0:
-            rows = query.all()
-        else:
-            found_rows = query.count()
-            offset = limit * page
-            rows = query[offset:(offset+limit)]
-            self.next_page = (found_rows > (offset+limit))
-        return rows
+        query = query.group_by(Author.author_id, Author.first_name, Author.last_name, Author.search_name)
+        return self.getpage(query, (Author.search_name, Author.author_id), lambda row: (row[4], row[0]),
+                            limit, page, after, before)
 
-    def getbooksforauthor(self, author_id, limit=0, page=0, doublicates=True):
-        query = self.session.query(Book).filter(Book.book_id == book_authors.c.book_id,
-                                                book_authors.c.author_id == author_id)
+    def getbooksforauthor(self, author_id, limit=0, page=0, doublicates=True, after=None, before=None):
+        query = self.bookquery().filter(Book.book_id == book_authors.c.book_id,
+                                        book_authors.c.author_id == author_id)
         if not doublicates:
             query = query.filter(Book.doublicat == 0)
-        query = query.order_by(Book.title)
-        if limit == 0:
-            books = query.all()
-            self.next_page = False
-        else:
-            found_rows = query.count()
-            offset = limit * page
-            books = query[offset:(offset+limit)]
-            self.next_page = (found_rows > (offset+limit))
-        return books
+        return self.getpage(query, (Book.title, Book.book_id), lambda book: (book.title, book.book_id),
+                            limit, page, after, before)
 
     def getlastbooks(self, limit=0):
-        query = self.session.query(Book).order_by(Book.registerdate.desc())
+        query = self.bookquery().order_by(Book.registerdate.desc())
         if limit == 0:
             books = query.all()
         else:
@@ -430,47 +1113,39 @@ class opdsDatabase:
         return books
 
     def getgenres_sections(self):
-        squery = self.session.query(book_genre.c.genre_id, sql.func.count(book_genre.c.book_id).label('book_count')).\
-            group_by(book_genre.c.genre_id).subquery()
-        rows = self.session.query(sql.func.min(Genre.genre_id), Genre.section, sql.func.sum(squery.c.book_count)).\
-            join(squery, Genre.genre_id == squery.c.genre_id).group_by(Genre.section).order_by(Genre.section).all()
+        # секции суммируются по счётчикам жанров - это несколько сотен строк, а не вся bgenres
+        query = self.session.query(sql.func.min(Genre.genre_id), Genre.section, sql.func.sum(Counter.value)).\
+            join(Counter, sql.and_(Counter.name == 'genre', Counter.key == Genre.genre_id)).\
+            filter(Counter.value > 0).group_by(Genre.section).order_by(Genre.section)
+        if not self.countersready():
+            self.rebuildcounters()
+        rows = query.all()
         return rows
 
     def getgenres_subsections(self, section_id):
         genre = self.session.query(Genre).get(section_id)
         if not genre:
             return tuple()
-        query = self.session.query(Genre.genre_id, Genre.subsection, sql.func.count(book_genre)).\
-            filter(Genre.genre_id == book_genre.c.genre_id, Genre.section == genre.section).\
-            group_by(Genre.genre_id, Genre.subsection).order_by(Genre.subsection)
+        query = self.session.query(Genre.genre_id, Genre.subsection, Counter.value).\
+            join(Counter, sql.and_(Counter.name == 'genre', Counter.key == Genre.genre_id)).\
+            filter(Genre.section == genre.section, Counter.value > 0).order_by(Genre.subsection)
+        if not self.countersready():
+            self.rebuildcounters()
         rows = query.all()
         return rows
 
-    def getbooksforgenre(self, genre_id, limit=0, page=0, doublicates=True):
-        query = self.session.query(Book).filter(Book.book_id == book_genre.c.book_id,
-                                                book_genre.c.genre_id == genre_id)
+    def getbooksforgenre(self, genre_id, limit=0, page=0, doublicates=True, after=None, before=None):
+        query = self.bookquery().filter(Book.book_id == book_genre.c.book_id,
+                                        book_genre.c.genre_id == genre_id)
         if not doublicates:
             query = query.filter(Book.doublicat == 0)
-        query = query.order_by(Book.lang, Book.title)
-        if limit == 0:
-            books = query.all()
-            self.next_page = False
-        else:
-            found_rows = query.count()
-            offset = limit * page
-            books = query[offset:(offset+limit)]
-            self.next_page = (found_rows > (offset+limit))
-        return books
+        return self.getpage(query, (Book.lang, Book.title, Book.book_id),
+                            lambda book: (book.lang, book.title, book.book_id), limit, page, after, before)
 
     def getdbinfo(self, doublicates=True):
-        query = self.session.query(sql.func.count(Book.book_id))
-        if not doublicates:
-            query = query.filter(Book.doublicat == 0)
-        query = query.union_all(self.session.query(sql.func.count(Author.author_id)),
-                            self.session.query(sql.func.count(Catalog.cat_id)))
-        rows = query.all()
-        return rows[0][0], rows[1][0], rows[2][0]
-
+        counters = self.getcounters('books' if doublicates else 'books_nodup')
+        books = counters.get(0, 0)
+        return books, self.getcounters('authors').get(0, 0), self.getcounters('catalogs').get(0, 0)
 
     def zipisscanned(self, zipname):
         _catalog = self.session.query(Catalog).filter(Catalog.path == zipname).order_by(Catalog.cat_id).first()
@@ -480,10 +1155,159 @@ class opdsDatabase:
             cat_id = _catalog.cat_id
         return cat_id
 
+    ##########################################################################
+    # Состояние файлов библиотеки (размер, время изменения, inode) для
+    # инкрементального сканирования
+    #
+    def getfilestates(self, prefix=None):
+        """
+        Состояния всех файлов библиотеки, или только файла (каталога) prefix и всего, что в нём лежит
+
+        """
+        if self.batch_filestates:
+            self.flush_batch()
+        query = self.session.query(FileState.path, FileState.size, FileState.mtime, FileState.inode)
+        if prefix is not None:
+            query = query.filter(sql.or_(FileState.path == prefix,
+                                         sql.func.substr(FileState.path, 1, len(prefix) + 1) == prefix + os.sep))
+        return {path: (size, mtime, inode) for (path, size, mtime, inode) in query}
+
+    def addfilestate(self, path, size, mtime, inode, digest=None):
+        row = {'path': path, 'size': size, 'mtime': mtime, 'inode': inode, 'digest': digest}
+        if self.batch_size:
+            self.batch_filestates.append(row)
+            if len(self.batch_filestates) + len(self.batch_zipmembers) >= self.batch_size:
+                self.flush_batch()
+        else:
+            self.session.execute(FileState.__table__.insert().values(row))
+            self.session.commit()
+
+    def getfiledigest(self, path):
+        if self.batch_filestates:
+            self.flush_batch()
+        row = self.session.query(FileState.digest).filter(FileState.path == path).first()
+        return row[0] if row else None
+
+    def delfilestate(self, path):
+        if self.batch_size:
+            self.flush_batch()
+        self.session.query(FileState).filter(FileState.path == path).delete(synchronize_session=False)
+        self.session.query(ZipMember).filter(ZipMember.path == path).delete(synchronize_session=False)
+        self.commit()
+
+    def getcheckpoint(self, scan):
+        """
+        Отметка о ходе прерванного сканирования: (путь, книга архива) или None
+
+        """
+        if self.batch_checkpoints:
+            self.flush_batch()
+        checkpoint = self.session.query(Checkpoint).get(scan)
+        return (checkpoint.path, checkpoint.member) if checkpoint else None
+
+    def setcheckpoint(self, scan, path='', member=''):
+        if self.batch_size:
+            self.batch_checkpoints[scan] = (path, member)
+        else:
+            self.session.merge(Checkpoint(scan, path, member))
+            self.session.commit()
+
+    def delcheckpoint(self, scan):
+        self.batch_checkpoints.pop(scan, None)
+        self.session.query(Checkpoint).filter(Checkpoint.scan == scan).delete(synchronize_session=False)
+        self.commit()
+
+    def clearfilestates(self):
+        self.session.query(FileState).delete(synchronize_session=False)
+        self.session.query(ZipMember).delete(synchronize_session=False)
+        self.commit()
+
+    def getzipmembers(self, path):
+        if self.batch_zipmembers:
+            self.flush_batch()
+        return {name: (crc, size) for (name, crc, size) in
+                self.session.query(ZipMember.name, ZipMember.crc, ZipMember.size).filter(ZipMember.path == path)}
+
+    def addzipmembers(self, path, members):
+        """
+        Сохранение состава ZIP архива: members - список (имя, CRC32, размер).
+        Фиксируется вместе со следующим addfilestate, чтобы состав архива
+        не оказался в БД без его состояния.
+
+        """
+        rows = [{'path': path, 'name': name, 'crc': crc, 'size': size} for (name, crc, size) in members]
+        if self.batch_size:
+            self.batch_zipmembers.extend(rows)
+        else:
+            self.insert_rows(ZipMember.__table__, rows)
+
+    def delzipbooks(self, path, names):
+        """
+        Удаление книг names из архива path
+
+        """
+        names = list(names)
+        book_ids = []
+        for i in range(0, len(names), BATCH_PARAMS):
+            book_ids.extend(book_id for (book_id,) in self.session.query(Book.book_id).
+                            filter(Book.path == path, Book.filename.in_(names[i:i+BATCH_PARAMS])))
+        self.delbooks(book_ids)
+        return len(book_ids)
+
+    def delfile(self, path):
+        """
+        Удаление из БД файла библиотеки: книги (для ZIP - все книги архива), их связи
+        с авторами и жанрами, каталог архива и запись о состоянии файла.
+
+        """
+        (head, tail) = os.path.split(path)
+        query = self.session.query(Book.book_id).filter(sql.or_(Book.path == path,
+                                                                sql.and_(Book.path == (head or '.'),
+                                                                         Book.filename == tail)))
+        book_ids = [book_id for (book_id,) in query]
+        self.delbooks(book_ids)
+        count = self.session.query(Catalog).filter(Catalog.path == path, Catalog.cat_type == CAT_ZIP). \
+            delete(synchronize_session=False)
+        self.count('catalogs', 0, -count)
+        if self.cat_cache is not None:
+            self.cat_cache.data.pop(path, None)
+        self.delfilestate(path)
+        return len(book_ids)
+
+    def delbooks(self, book_ids):
+        if self.batch_size:
+            self.flush_batch()
+        book_ids = list(book_ids)
+        for i in range(0, len(book_ids), BATCH_PARAMS):
+            ids = book_ids[i:i+BATCH_PARAMS]
+            for (title, doublicat) in self.session.query(Book.title, Book.doublicat).filter(Book.book_id.in_(ids)):
+                self.countbook(title, doublicat, -1)
+            for (genre_id, cnt) in self.session.query(book_genre.c.genre_id, sql.func.count(book_genre.c.book_id)).\
+                    filter(book_genre.c.book_id.in_(ids)).group_by(book_genre.c.genre_id):
+                self.count('genre', genre_id, -cnt)
+            if self.searchready():
+                self.session.execute(books_fts.delete().where(books_fts.c.rowid.in_(ids)))
+            self.session.execute(book_authors.delete().where(book_authors.c.book_id.in_(ids)))
+            self.session.execute(book_genre.delete().where(book_genre.c.book_id.in_(ids)))
+            self.session.query(BookHash).filter(BookHash.book_id.in_(ids)).delete(synchronize_session=False)
+            self.session.query(Book).filter(Book.book_id.in_(ids)).delete(synchronize_session=False)
+        self.commit()
+
     def __del__(self):
         self.close_db()
 
 
+    def create_tables(self):
+        Base.metadata.create_all(self.engine)
+        # индексы, добавленные в уже существующие таблицы
+        inspector = sql.inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
+        self.createsearch()
+
     def init_db(self):
         """
         Инициализация базы данных
@@ -491,7 +1315,7 @@ class opdsDatabase:
         """
         if not self.is_open:
             self.open_db()
-        Base.metadata.create_all(self.engine)
+        self.create_tables()
         self.addauthor('', UNKNOWN_AUTHOR)
 
         self.session.add(Genre("sf_history", "Альтернативная история", "Фантастика"))
@@ -604,6 +1428,7 @@ class opdsDatabase:
         self.session.add(Genre("home_sex", "Эротика, Секс", "Дом и семья"))
         self.session.add(Genre("home", "Прочее домоводство", "Дом и семья"))
         self.session.commit()
+        self.rebuildcounters()
 
 
 if __name__ == '__main__':
@@ -663,6 +1488,48 @@ if __name__ == '__main__':
             self.assertEqual(book.cover, FILENAME)
             self.assertEqual(book.cover_type, FORMAT)
 
+        def test_finddouble_hash(self):
+            self.db.addbook(FILENAME+'1', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 1, '', 'aa')
+            book = self.db.addbook(FILENAME+'2', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 1, '', 'bb')
+            self.assertEqual(book.doublicat, 0)
+            book = self.db.addbook(FILENAME+'3', PATH_BOOK, 0, '.'+FORMAT, 'other', 'ru', 1, 0, 1, '', 'aa')
+            self.assertEqual(book.doublicat, 1)
+            self.db.delbooks([1])
+            self.assertEqual(self.db.finddouble(TILE_BOOK, FORMAT, SIZE_BOOK, 'aa'), 0)
+
+        def test_rededup(self):
+            for i in range(4):
+                self.db.addbook(FILENAME+str(i), PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0)
+            self.assertEqual(self.db.rededup(), 3)
+            self.assertEqual([book.doublicat for book in self.db.session.query(Book).order_by(Book.book_id)],
+                             [0, 1, 1, 1])
+            self.db.delbooks([1])
+            self.assertEqual(self.db.rededup(), 3)
+            self.assertEqual([book.doublicat for book in self.db.session.query(Book).order_by(Book.book_id)],
+                             [0, 2, 2])
+            self.assertEqual(self.db.rededup(), 0)
+
+        def test_checkpoint(self):
+            self.assertEqual(self.db.getcheckpoint('scanall'), None)
+            self.db.begin_batch(10)
+            self.db.setcheckpoint('scanall', 'a.zip', '1.fb2')
+            self.db.setcheckpoint('scanall', 'a.zip', '2.fb2')
+            self.assertEqual(self.db.session.query(Checkpoint).count(), 0)
+            self.assertEqual(self.db.getcheckpoint('scanall'), ('a.zip', '2.fb2'))
+            self.db.end_batch()
+            self.db.setcheckpoint('scanall', 'b.fb2')
+            self.assertEqual(self.db.getcheckpoint('scanall'), ('b.fb2', ''))
+            self.db.delcheckpoint('scanall')
+            self.assertEqual(self.db.getcheckpoint('scanall'), None)
+
+        def test_addcovers(self):
+            book_id1 = self.db.addbook(FILENAME+'1', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0).book_id
+            book_id2 = self.db.addbook(FILENAME+'2', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0).book_id
+            self.db.addcovers([(book_id1, '1.jpg', 'image/jpeg'), (book_id2, '2.png', 'image/png')])
+            self.db.session.expire_all()
+            self.assertEqual(self.db.getbook(book_id1).cover, '1.jpg')
+            self.assertEqual(self.db.getbook(book_id2).cover_type, 'image/png')
+
         def test_findauthor(self):
             self.assertEqual(self.db.findauthor('Какойто', 'Fdnjh'), None)
             self.assertNotEqual(self.db.findauthor('', UNKNOWN_AUTHOR), None)
@@ -813,6 +1680,64 @@ if __name__ == '__main__':
             self.assertEqual(len(rows), 1)
             self.assertEqual(rows[0][1], 3)
 
+        def test_prefixes(self):
+            def grouped(letters):
+                column = sql.func.substr(Book.title, 1, len(letters) + 1)
+                return self.db.session.query(column, sql.func.count('*')). \
+                    filter(Book.search_title.like(letters.lower() + '%')).group_by(column).order_by(column).all()
+            self.db.begin_batch(2)
+            for (i, title) in enumerate(('Имя', 'имя книжки', 'Им', 'И', '', 'Abc', 'ABd', TILE_BOOK)):
+                self.db.addbook(FILENAME+str(i), PATH_BOOK, 0, '.'+FORMAT, title, 'ru', SIZE_BOOK, 0, 0)
+            self.db.end_batch()
+            self.db.delbooks([self.db.findbook(FILENAME+'2', PATH_BOOK).book_id])
+            for letters in ('', 'И', 'им', 'Имя', 'Имя ', 'a', 'ab'):
+                self.assertEqual(self.db.gettitle_2letters(letters), grouped(letters))
+            self.db.rebuildcounters()
+            for letters in ('', 'и', 'им', 'имя', 'a'):
+                self.assertEqual(self.db.gettitle_2letters(letters), grouped(letters))
+
+        def test_bookquery(self):
+            genre_id = self.db.findgenre('sf').genre_id
+            cat_id = self.db.addcattree(PATH_BOOK)
+            for i in range(3):
+                book_id = self.db.addbook(FILENAME+str(i), PATH_BOOK, cat_id, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0,
+                                          0).book_id
+                self.db.addbauthor(book_id, self.db.addauthor(FIRST, LAST+str(i)).author_id)
+                self.db.addbgenre(book_id, genre_id)
+            self.db.session.expire_all()
+            books = self.db.getbooksforgenre(genre_id).items + [row[6] for row in self.db.getitemsincat(cat_id)]
+            statements = []
+            sql.event.listen(self.db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            self.assertEqual(sum(len(book.authors) + len(book.genres) for book in books), 12)
+            self.assertEqual(statements, [])
+
+        def test_searchbooks(self):
+            book_id1 = self.db.addbook(FILENAME+'1', PATH_BOOK, 0, '.'+FORMAT, 'Война и мир', 'ru', SIZE_BOOK, 0, 0,
+                                       'Роман-эпопея').book_id
+            self.db.addbauthor(book_id1, self.db.addauthor('Лев', 'Толстой').author_id)
+            self.db.begin_batch(2)
+            book_id2 = self.db.addbook(FILENAME+'2', PATH_BOOK, 0, '.'+FORMAT, 'ВОЙНА миров', 'ru', SIZE_BOOK, 0,
+                                       0).book_id
+            self.db.addbauthor(book_id2, self.db.getauthor_id('Герберт', 'Уэллс'))
+            book_id3 = self.db.addbook(FILENAME+'3', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0,
+                                       'Про войну').book_id
+            self.db.end_batch()
+            self.assertEqual({book.book_id for book in self.db.searchbooks('вой')}, {book_id1, book_id2, book_id3})
+            self.assertEqual([book.book_id for book in self.db.searchbooks('толст')], [book_id1])
+            self.assertEqual([book.book_id for book in self.db.searchbooks('уэллс война')], [book_id2])
+            self.assertEqual([book.book_id for book in self.db.searchbooks('эпопе')], [book_id1])
+            self.assertEqual(len(self.db.searchbooks(' "* ')), 0)
+            page = self.db.searchbooks('вой', 2)
+            self.assertTrue(page.has_next)
+            books = page.items
+            page = self.db.searchbooks('вой', 2, after=page.next_cursor)
+            self.assertFalse(page.has_next)
+            self.assertEqual(books + page.items, self.db.searchbooks('вой').items)
+            self.db.delbooks([book_id1])
+            self.assertEqual(len(self.db.searchbooks('вой')), 2)
+            self.db.rebuildsearch()
+            self.assertEqual(len(self.db.searchbooks('вой')), 2)
+
         def test_getbooksfortitle(self):
             #name, path, cat_id, exten, title, lang, size=0, archive=0, doublicates=0
             book_id1 = self.db.addbook(FILENAME+'1', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0)
@@ -820,6 +1745,27 @@ if __name__ == '__main__':
             book_id3 = self.db.addbook(FILENAME+'3', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK+'2', 'ru', SIZE_BOOK, 0, 0)
             self.assertEqual(len(self.db.getbooksfortitle(TILE_BOOK)), 3)
 
+        def test_getpage(self):
+            for i in range(5):
+                self.db.addbook(FILENAME+str(i), PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK+str(i % 2), 'ru', SIZE_BOOK, 0, 0)
+            expected = [book.book_id for book in self.db.getbooksfortitle(TILE_BOOK)]
+            page = self.db.getbooksfortitle(TILE_BOOK, 2)
+            self.assertEqual(page.prev_cursor, None)
+            pages = [page]
+            while page.has_next:
+                page = self.db.getbooksfortitle(TILE_BOOK, 2, after=page.next_cursor)
+                pages.append(page)
+            self.assertEqual([book.book_id for page in pages for book in page], expected)
+            self.assertEqual(len(pages), 3)
+            self.assertEqual(page.next_cursor, None)
+            page = self.db.getbooksfortitle(TILE_BOOK, 2, before=page.prev_cursor)
+            self.assertEqual(page.items, pages[1].items)
+            self.assertTrue(page.has_next)
+            self.assertEqual(self.db.getbooksfortitle(TILE_BOOK, 2, 1).items, pages[1].items)
+            # испорченный курсор - первая страница
+            for cursor in ((), (TILE_BOOK,), ([1], 2), (TILE_BOOK, 1, 2)):
+                self.assertEqual(self.db.getbooksfortitle(TILE_BOOK, 2, after=cursor).items, pages[0].items)
+
         def test_getauthorsbyl(self):
             self.assertEqual(len(self.db.getauthorsbyl(FIRST)), 0)
             book_id1 = self.db.addbook(FILENAME+'1', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, TILE_BOOK, '', 0, 0).book_id
@@ -919,6 +1865,119 @@ if __name__ == '__main__':
         def test_getdbinfo(self):
             self.assertEqual(self.db.getdbinfo(), (0,1,0))
 
+        def test_counters(self):
+            genre_id1 = self.db.findgenre('sf_history').genre_id
+            genre_id2 = self.db.findgenre('sf_humor').genre_id
+            cat_id = self.db.addcattree(PATH_BOOK)
+            book_id1 = self.db.addbook(FILENAME+'1', PATH_BOOK, cat_id, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 1).book_id
+            self.db.addbgenre(book_id1, genre_id1)
+            self.db.begin_batch(2)
+            for i in range(2, 6):
+                book_id = self.db.addbook(FILENAME+str(i), PATH_BOOK, cat_id, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0,
+                                          1).book_id
+                self.db.addbauthor(book_id, self.db.getauthor_id(FIRST, LAST + str(i % 2)))
+                self.db.addbgenre(book_id, genre_id1 if i % 2 else genre_id2)
+            self.db.end_batch()
+            self.db.delbooks([book_id1])
+            self.assertEqual(self.db.getdbinfo(), (4, 3, 4))
+            self.assertEqual(self.db.getdbinfo(False), (0, 3, 4))
+            sections = self.db.getgenres_sections()
+            subsections = self.db.getgenres_subsections(genre_id1)
+            self.assertEqual([row[2] for row in subsections], [2, 2])
+            self.db.rebuildcounters()
+            self.assertEqual(self.db.getdbinfo(False), (0, 3, 4))
+            self.assertEqual(self.db.getgenres_sections(), sections)
+            self.assertEqual(self.db.getgenres_subsections(genre_id1), subsections)
+
+        def test_batch(self):
+            self.db.begin_batch(2)
+            book_id1 = self.db.addbook(FILENAME+'1', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0).book_id
+            book_id2 = self.db.addbook(FILENAME+'2', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0).book_id
+            author_id = self.db.addauthor(FIRST, LAST).author_id
+            self.db.addbauthor(book_id1, author_id)
+            self.db.addbauthor(book_id1, author_id)
+            self.db.addbauthor(book_id2, 1)
+            self.db.addbgenre(book_id1, 10)
+            self.db.addbgenre(book_id2, 10)
+            self.assertEqual(self.db.session.query(book_authors).count(), 0)
+            self.assertEqual(self.db.findbook(FILENAME+'2', PATH_BOOK).book_id, book_id2)
+            book_id3 = self.db.addbook(FILENAME+'3', PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0).book_id
+            self.assertEqual(self.db.session.query(book_authors).count(), 2)
+            self.db.addbgenre(book_id3, 1)
+            self.db.end_batch()
+            self.assertEqual(self.db.session.query(book_genre).count(), 3)
+            self.assertTrue(self.db.findbauthor(book_id1, author_id))
+            self.assertTrue(self.db.findbgenre(book_id3, 1))
+
+        def test_cache(self):
+            self.db.addcattree(PATH_BOOK)
+            self.db.load_cache(1000)
+            self.assertTrue(self.db.author_cache.complete)
+            self.assertEqual(self.db.getauthor_id('', UNKNOWN_AUTHOR), 1)
+            author_id = self.db.getauthor_id(FIRST, LAST)
+            self.assertEqual(self.db.findauthor(FIRST, LAST).author_id, author_id)
+            self.assertEqual(self.db.getauthor_id(FIRST, LAST), author_id)
+            self.assertEqual(self.db.getgenre_id('sf_humor'), 10)
+            genre_id = self.db.getgenre_id('unknown')
+            self.assertEqual(self.db.findgenre('unknown').genre_id, genre_id)
+            self.assertEqual(self.db.addcattree(PATH_BOOK), self.db.findcat(PATH_BOOK))
+            cat_id = self.db.addcattree(os.path.join(PATH_BOOK, 'file.zip'), 1)
+            self.assertEqual(self.db.findcat(os.path.join(PATH_BOOK, 'file.zip')), cat_id)
+
+        def test_cache_bounded(self):
+            self.db.load_cache(2)
+            self.assertFalse(self.db.genre_cache.complete)
+            self.assertEqual(len(self.db.genre_cache.data), 2)
+            self.assertEqual(self.db.getgenre_id('sf_humor'), 10)
+            self.assertEqual(self.db.getgenre_id('sf'), 12)
+            self.assertEqual(len(self.db.genre_cache.data), 2)
+            self.assertEqual(self.db.getauthor_id('', UNKNOWN_AUTHOR), 1)
+            self.assertEqual(self.db.getauthor_id(FIRST, LAST), self.db.getauthor_id(FIRST, LAST))
+            self.assertEqual(self.db.session.query(Author).count(), 2)
+
+        def test_filestate(self):
+            self.assertEqual(self.db.getfilestates(), {})
+            self.db.addfilestate(os.path.join(PATH_BOOK, FILENAME), SIZE_BOOK, 10, 20)
+            self.db.addfilestate(os.path.join(PATH_BOOK, 'file.zip'), SIZE_BOOK, 10, 21)
+            self.assertEqual(self.db.getfilestates()[os.path.join(PATH_BOOK, FILENAME)], (SIZE_BOOK, 10, 20))
+            self.assertEqual(len(self.db.getfilestates(PATH_BOOK)), 2)
+            self.assertEqual(len(self.db.getfilestates(os.path.join(PATH_BOOK, FILENAME))), 1)
+            self.assertEqual(len(self.db.getfilestates(PATH_BOOK[:-1])), 0)
+            self.db.clearfilestates()
+            self.assertEqual(self.db.getfilestates(), {})
+
+        def test_delfile(self):
+            book_id = self.db.addbook(FILENAME, PATH_BOOK, 0, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, 0, 0).book_id
+            self.db.addbauthor(book_id, 1)
+            self.db.addbgenre(book_id, 10)
+            zip_path = os.path.join(PATH_BOOK, 'file.zip')
+            cat_id = self.db.addcattree(zip_path, CAT_ZIP)
+            self.db.addbook(FILENAME, zip_path, cat_id, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, CAT_ZIP, 0)
+            self.db.addbook(FILENAME+'1', zip_path, cat_id, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, CAT_ZIP, 0)
+            self.db.addfilestate(zip_path, SIZE_BOOK, 10, 21)
+            self.assertEqual(self.db.delfile(zip_path), 2)
+            self.assertEqual(self.db.zipisscanned(zip_path), 0)
+            self.assertEqual(self.db.getfilestates(), {})
+            self.assertEqual(self.db.delfile(os.path.join(PATH_BOOK, FILENAME)), 1)
+            self.assertEqual(self.db.findbook(FILENAME, PATH_BOOK), None)
+            self.assertEqual(self.db.session.query(book_authors).count(), 0)
+            self.assertEqual(self.db.session.query(book_genre).count(), 0)
+
+        def test_zipmembers(self):
+            zip_path = os.path.join(PATH_BOOK, 'file.zip')
+            cat_id = self.db.addcattree(zip_path, CAT_ZIP)
+            self.db.addbook(FILENAME, zip_path, cat_id, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, CAT_ZIP, 0)
+            self.db.addbook(FILENAME+'1', zip_path, cat_id, '.'+FORMAT, TILE_BOOK, 'ru', SIZE_BOOK, CAT_ZIP, 0)
+            self.db.addzipmembers(zip_path, [(FILENAME, 1, SIZE_BOOK), (FILENAME+'1', 2, SIZE_BOOK)])
+            self.db.addfilestate(zip_path, SIZE_BOOK, 10, 21, 'digest')
+            self.assertEqual(self.db.getfiledigest(zip_path), 'digest')
+            self.assertEqual(self.db.getzipmembers(zip_path), {FILENAME: (1, SIZE_BOOK), FILENAME+'1': (2, SIZE_BOOK)})
+            self.assertEqual(self.db.delzipbooks(zip_path, [FILENAME+'1', FILENAME+'2']), 1)
+            self.assertNotEqual(self.db.findbook(FILENAME, zip_path), None)
+            self.db.delfilestate(zip_path)
+            self.assertEqual(self.db.getfiledigest(zip_path), None)
+            self.assertEqual(self.db.getzipmembers(zip_path), {})
+
         def test_zipisscanned(self):
             cat_id = self.db.addcattree(os.path.join(PATH_BOOK, 'file.zip'))
             self.assertEqual(self.db.zipisscanned(os.path.join(PATH_BOOK, 'file.zip')), cat_id)
@@ -1,21 +1,189 @@
 __author__ = 'vseklecov'
 
+import base64
 import os
+import re
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import unescape
 
 import db
 
 
-def fb2parse(filename):
+FB2_CHUNK = 64 * 1024
+
+BINARY_OPEN = b'<binary'
+BINARY_CLOSE = b'</binary>'
+ATTR_RE = re.compile(rb'([\w:.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+
+def localname(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class FB2Stream:
+    """
+    Потоковый разбор fb2: документ читается порциями по FB2_CHUNK байт и
+    разбирается ровно настолько, насколько это нужно.
+    hsize - предельный размер заголовка (до </description>) в байтах, 0 - без ограничения.
+
+    """
+    def __init__(self, source, hsize=0):
+        if isinstance(source, str):
+            self.file = open(source, 'rb')
+            self.own_file = True
+        else:
+            self.file = source
+            self.own_file = False
+        self.hsize = hsize
+        self.limit = 0
+        self.parser = ET.XMLPullParser(('start', 'end'))
+        self.root = None
+        self.depth = 0
+        self.size = 0
+        self.head = b''
+        self.last = b''
+
+    def events(self):
+        while True:
+            for event, elem in self.parser.read_events():
+                if event == 'start':
+                    if self.root is None:
+                        self.root = elem
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                yield event, elem
+            if self.parser is None:
+                return
+            size = FB2_CHUNK
+            if self.limit:
+                # читается не дальше предела, а не целыми порциями
+                size = min(size, self.limit - self.size)
+                if size <= 0:
+                    raise ET.ParseError('FB2 header is larger than {:d} bytes'.format(self.limit))
+            data = self.file.read(size)
+            if data:
+                if not self.size:
+                    self.head = data[:4]
+                self.size += len(data)
+                self.last = data
+                self.parser.feed(data)
+            else:
+                parser, self.parser = self.parser, None
+                parser.close()
+
+    def description(self):
+        """
+        Читает документ до </description> и возвращает элемент description
+        (или None, если его нет). Тело книги и бинарные вложения не читаются.
+
+        """
+        self.limit = self.hsize
+        try:
+            for event, elem in self.events():
+                if event == 'end' and self.depth == 1 and localname(elem.tag) == 'description':
+                    return elem
+        finally:
+            self.limit = 0
+        return None
+
+    def binary(self, _id):
+        """
+        Ищет после description вложение <binary id="_id"> и возвращает пару
+        (content-type, данные) или None.
+        Остаток документа просматривается как поток байт: тело книги и прочие вложения
+        не разбираются и не накапливаются, декодируется только найденное вложение.
+
+        """
+        if self.head.startswith((b'\xff\xfe', b'\xfe\xff')) or b'\0' in self.head:
+            return self.binary_tree(_id)
+        buf = self.last
+        while True:
+            pos = buf.find(BINARY_OPEN)
+            if pos < 0:
+                buf = buf[-len(BINARY_OPEN):]
+            else:
+                end = buf.find(b'>', pos)
+                if end >= 0:
+                    attrs = self.attributes(buf[pos + len(BINARY_OPEN):end])
+                    buf = buf[end + 1:]
+                    if attrs.get('id') == _id:
+                        return attrs.get('content-type', ''), self.content(buf)
+                    buf = self.skip(buf)
+                    if buf is None:
+                        return None
+                    continue
+                buf = buf[pos:]
+            data = self.file.read(FB2_CHUNK)
+            if not data:
+                return None
+            buf += data
+
+    @staticmethod
+    def attributes(data):
+        attrs = {}
+        for m in ATTR_RE.finditer(data):
+            value = m.group(2) if m.group(2) is not None else m.group(3)
+            attrs[m.group(1).decode('ascii', 'replace')] = unescape(value.decode('utf-8', 'replace'),
+                                                                    {'&quot;': '"', '&apos;': "'"})
+        return attrs
+
+    def skip(self, buf):
+        while True:
+            pos = buf.find(BINARY_CLOSE)
+            if pos >= 0:
+                return buf[pos + len(BINARY_CLOSE):]
+            data = self.file.read(FB2_CHUNK)
+            if not data:
+                return None
+            buf = buf[-len(BINARY_CLOSE):] + data
+
+    def content(self, buf):
+        chunks = []
+        while True:
+            pos = buf.find(BINARY_CLOSE)
+            if pos >= 0:
+                chunks.append(buf[:pos])
+                break
+            keep = len(BINARY_CLOSE) - 1
+            chunks.append(buf[:-keep])
+            data = self.file.read(FB2_CHUNK)
+            if not data:
+                chunks.append(buf[-keep:])
+                break
+            buf = buf[-keep:] + data
+        return base64.b64decode(b''.join(chunks))
+
+    def binary_tree(self, _id):
+        """
+        Запасной вариант для документов в кодировках, несовместимых с ASCII (UTF-16):
+        продолжает разбор XML, отбрасывая уже разобранные элементы верхнего уровня.
+
+        """
+        try:
+            for event, elem in self.events():
+                if event == 'end' and self.depth == 1:
+                    if localname(elem.tag) == 'binary' and elem.get('id') == _id:
+                        return elem.get('content-type', ''), base64.b64decode(elem.text or '')
+                    self.root.remove(elem)
+        except ET.ParseError:
+            pass
+        return None
+
+    def close(self):
+        if self.own_file:
+            self.file.close()
+
+
+def fb2parse(filename, hsize=0):
     ret = {'genres': [], 'authors': []}
-    if isinstance(filename, str):
-        tree = ET.parse(filename)
-    else:
-        tree = ET.fromstring(filename.read())
-    root = tree.getroot()
-    ns = root.tag.split('}')[0][1:]
+    stream = FB2Stream(filename, hsize)
+    try:
+        description = stream.description()
+    finally:
+        stream.close()
+    ns = stream.root.tag.split('}')[0][1:]
 
-    description = root.find(ET.QName(ns, 'description').text)
     title_info = description.find(ET.QName(ns, 'title-info').text)
     ret['genres'] = [genre.text for genre in title_info.iter(ET.QName(ns, 'genre').text)]
 
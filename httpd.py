@@ -0,0 +1,317 @@
+__author__ = 'vseklecov'
+
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+##########################################################################
+# HTTP сервер для WSGI приложения на стандартной библиотеке.
+# Соединения обслуживает пул потоков; в режиме prefork несколько процессов
+# принимают соединения с общего слушающего сокета. Поддерживается keep-alive,
+# остановка по SIGTERM/SIGINT с завершением начатых запросов и перезапуск
+# процессов после max_requests запросов.
+#
+THREADS = 8
+MAX_REQUESTS = 1000     # запросов до перезапуска процесса в режиме prefork
+KEEPALIVE = 5           # секунд ожидания следующего запроса в соединении, 0 - без keep-alive
+TIMEOUT = 300           # секунд без обмена данными посреди запроса или ответа
+POLL_INTERVAL = 0.5     # секунд между проверками флага остановки
+MAX_LINE = 65536
+
+
+class KeepAliveHandler(ServerHandler):
+    """
+    Ответ HTTP/1.1: соединение остаётся открытым, если длина ответа известна
+
+    """
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        request = self.request_handler
+        if 'Content-Length' not in self.headers or request.server.finishing():
+            request.close_connection = True
+        if request.close_connection:
+            self.headers['Connection'] = 'close'
+
+    def finish_response(self):
+        """
+        На HEAD отдаются только заголовки: тело не передаётся и не читается дальше
+        первой порции (до неё приложение может отложить start_response)
+
+        """
+        if self.environ['REQUEST_METHOD'] != 'HEAD':
+            return ServerHandler.finish_response(self)
+        try:
+            for data in self.result:
+                # по длине единственной порции cleanup_headers ставит Content-Length
+                self.bytes_sent = len(data)
+                break
+            if not self.headers_sent:
+                self.send_headers()
+            self.bytes_sent = 0
+        except:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+            raise
+        else:
+            self.close()
+
+    def sendfile(self):
+        """
+        Файл из wsgi.file_wrapper передаётся ядром (socket.sendfile) с текущей позиции,
+        не более Content-Length байт; без fileno() - обычная отдача порциями
+
+        """
+        f = self.result.filelike
+        try:
+            f.fileno()
+        except (AttributeError, OSError, ValueError):
+            return False
+        length = self.headers.get('Content-Length')
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        count = int(length) if length else None
+        if count != 0:
+            self.bytes_sent += self.request_handler.connection.sendfile(f, f.tell(), count)
+        return True
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Обработчик соединения: запросы читаются по очереди, пока клиент не закроет
+    соединение или не истечёт keep-alive. При остановке сервера ещё один запрос
+    в открытом соединении обслуживается с ответом Connection: close
+
+    """
+    protocol_version = 'HTTP/1.1'
+    # заголовки и тело пишутся отдельно - без TCP_NODELAY keep-alive ждёт задержанного ACK
+    disable_nagle_algorithm = True
+
+    timeout = TIMEOUT
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        # keep-alive ограничивает только ожидание строки запроса, а не передачу ответа
+        self.connection.settimeout(self.server.keepalive or TIMEOUT)
+        try:
+            self.raw_requestline = self.rfile.readline(MAX_LINE + 1)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+        self.connection.settimeout(TIMEOUT)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > MAX_LINE:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            self.close_connection = True
+            return
+        if not self.server.keepalive or self.headers.get('Content-Length', '0') not in ('', '0'):
+            # тело запроса приложение не читает - соединение дальше не используется
+            self.close_connection = True
+        self.server.count()
+        handler = KeepAliveHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+                                   multithread=True, multiprocess=self.server.multiprocess)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            WSGIRequestHandler.log_message(self, format, *args)
+
+
+class PoolServer(WSGIServer):
+    """
+    WSGI сервер с фиксированным пулом потоков.
+    Принятые соединения ставятся в очередь и обслуживаются потоками пула;
+    serve() работает до stop() или до max_requests обслуженных запросов.
+
+    """
+    multiprocess = False
+
+    def __init__(self, address, app, threads=THREADS, keepalive=KEEPALIVE, max_requests=0, verbose=False,
+                 bind_and_activate=True):
+        WSGIServer.__init__(self, address, RequestHandler, bind_and_activate)
+        self.set_app(app)
+        self.threads = threads
+        self.keepalive = keepalive
+        self.max_requests = max_requests
+        self.verbose = verbose
+        self.stopping = False
+        self.served = 0
+        self.lock = threading.Lock()
+        self.connections = queue.Queue()
+        self.workers = []
+
+    def start(self):
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        while True:
+            item = self.connections.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+
+    def handle_timeout(self):
+        pass
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def count(self):
+        with self.lock:
+            self.served += 1
+
+    def finishing(self):
+        return self.stopping or self.max_requests and self.served >= self.max_requests
+
+    def serve(self):
+        """
+        Приём соединений до остановки; затем дожидается завершения начатых запросов
+
+        """
+        self.timeout = POLL_INTERVAL
+        self.start()
+        try:
+            while not self.finishing():
+                self.handle_request()
+        finally:
+            self.stopping = True
+            for worker in self.workers:
+                self.connections.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+
+
+class PreforkServer:
+    """
+    workers процессов с пулом потоков в каждом принимают соединения с одного сокета.
+    Процесс, обслуживший max_requests запросов, завершается и заменяется новым;
+    init() вызывается в каждом процессе после fork (например, чтобы открыть БД).
+
+    """
+    def __init__(self, address, app, workers=2, threads=THREADS, keepalive=KEEPALIVE, max_requests=0,
+                 verbose=False, init=None):
+        self.workers = workers
+        self.verbose = verbose
+        self.init = init
+        self.server = PoolServer(address, app, threads, keepalive, max_requests, verbose)
+        self.server.multiprocess = True
+        # простаивающие процессы не должны блокироваться в accept() после соседа
+        self.server.socket.setblocking(False)
+        self.server_address = self.server.server_address
+        self.children = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, self.server.stop)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if self.init:
+                self.init()
+            self.server.serve()
+        except BaseException:
+            code = 1
+            sys.excepthook(*sys.exc_info())
+        finally:
+            os._exit(code)
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def serve(self):
+        """
+        Запуск процессов и их замена по мере завершения; после stop() процессам
+        посылается SIGTERM и ожидается их завершение
+
+        """
+        previous = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            while not self.stopping:
+                while len(self.children) < self.workers and not self.stopping:
+                    self.spawn()
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    pid = 0
+                if pid:
+                    self.children.discard(pid)
+                    if self.verbose:
+                        print('Worker {:d} exited with status {:d}'.format(pid, status))
+                else:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in self.children:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.children = set()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            self.server.server_close()
+
+
+def serve(app, host='', port=8000, workers=0, threads=THREADS, keepalive=KEEPALIVE, max_requests=0,
+          verbose=False, init=None):
+    """
+    Запуск сервера: workers = 0 - один процесс с пулом потоков,
+    иначе prefork с workers процессами
+
+    """
+    if workers > 0:
+        server = PreforkServer((host, port), app, workers, threads, keepalive, max_requests, verbose, init)
+        server.serve()
+        return
+    if init:
+        init()
+    server = PoolServer((host, port), app, threads, keepalive, 0, verbose)
+    previous = {sig: signal.signal(sig, server.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        server.serve()
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+        server.server_close()
@@ -3,17 +3,22 @@ from fb2parser import fb2parse
 
 __author__ = 'vseklecov'
 
-import io
+import base64
+import hashlib
+import json
 import logging
 import mimetypes
 import os
-from urllib.parse import parse_qs
+import tempfile
+import time
+from urllib.parse import parse_qs, quote
+from wsgiref.handlers import format_date_time
 from wsgiref.validate import validator
-from wsgiref.simple_server import make_server
 import zipfile
 
 import db as sopdsdb
-from utils import CfgReader, FictionBook
+import httpd
+from utils import CfgReader, FictionBook, containerbook, containerext, opencontainer, zipdataoffset
 
 cfg = CfgReader()
 
@@ -36,6 +41,9 @@ OUT_BOOK = 8
 OUT_ZIP_BOOK = 9
 OUT_COVER = 99
 
+OUT_CHUNK = 64 * 1024
+ZIP_MIN_DATE = (1980, 1, 1, 0, 0, 0)    # более ранние даты в ZIP не записываются
+
 
 class Link:
     def __init__(self, href, _type='application/atom+xml', **kwargs):
@@ -102,15 +110,33 @@ def make_entry_book(book):
     return _entry
 
 
-def make_href(id_value, slice_value=None, page_value=None):
+def cursor_to_str(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor, ensure_ascii=False).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def cursor_from_str(value):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode('utf-8'))
+    except ValueError:
+        return None
+    return tuple(cursor) if isinstance(cursor, list) else None
+
+
+def make_href(id_value, slice_value=None, page_value=None, after=None, before=None, search_term=''):
     ret = '/?id={:02d}'.format(id_value)
-    if slice_value:
+    if search_term:
+        ret += '&search={:s}'.format(quote(search_term))
+    elif slice_value:
         if isinstance(slice_value, str):
             ret += '{:s}'.format(slice_value)
         else:
             ret += '{:d}'.format(slice_value)
     if page_value:
-        ret += '&amp;page={:d}'.format(page_value)
+        ret += '&page={:d}'.format(page_value)
+    if after is not None:
+        ret += '&after={:s}'.format(cursor_to_str(after))
+    if before is not None:
+        ret += '&before={:s}'.format(cursor_to_str(before))
     return ret
 
 
@@ -135,14 +161,18 @@ def make_book(book):
     return _entry
 
 
-def add_previous_link(feed, id_value, page_value):
-    feed.links.append(AsqusitionLink(make_href(id_value, page_value=page_value - 1),
-                                     rel='prev', title='Previous page').to_dict())
+def add_previous_link(feed, id_value, slice_value, page, search_term=''):
+    if page.prev_cursor is not None:
+        feed.links.append(AsqusitionLink(make_href(id_value, slice_value, before=page.prev_cursor,
+                                                   search_term=search_term),
+                                         rel='prev', title='Previous page').to_dict())
 
 
-def add_next_link(feed, id_value, page_value):
-    feed.links.append(AsqusitionLink(make_href(id_value, page_value=page_value + 1),
-                                     rel='next', title='Next page').to_dict())
+def add_next_link(feed, id_value, slice_value, page, search_term=''):
+    if page.has_next:
+        feed.links.append(AsqusitionLink(make_href(id_value, slice_value, after=page.next_cursor,
+                                                   search_term=search_term),
+                                         rel='next', title='Next page').to_dict())
 
 
 def letter_from_slice(slice_value):
@@ -218,13 +248,11 @@ def covers(cover, cover_type, book_id):
 #########################################################
 # Выбрана сортировка "По каталогам"
 #
-def list_of_catalogs(slice_value=0, page_value=0):
+def list_of_catalogs(slice_value=0, page_value=0, after=None, before=None):
     _feed = make_feed()
-    if page_value > 0:
-        add_previous_link(_feed, LIST_CAT, page_value)
-    for (item_type, item_id, item_name, item_path, reg_date, item_title) in opdsdb.getitemsincat(slice_value,
-                                                                                                 cfg.MAXITEMS,
-                                                                                                 page_value):
+    items = opdsdb.getitemsincat(slice_value, cfg.MAXITEMS, page_value, after, before)
+    add_previous_link(_feed, LIST_CAT, slice_value, items)
+    for (item_type, item_id, item_name, item_path, reg_date, item_title, book) in items:
         if item_type == 1:
             _id = make_href(LIST_CAT, item_id)
             _entry = pyatom.FeedEntry(title=item_title or item_name,
@@ -234,11 +262,9 @@ def list_of_catalogs(slice_value=0, page_value=0):
             _entry.links.append(Link(_id, rel='alternate').to_dict())
             _feed.add(_entry)
         elif item_type == 2:
-            book = opdsdb.getbook(item_id)
             _feed.add(make_book(book))
 
-    if opdsdb.next_page:
-        add_next_link(_feed, LIST_CAT, page_value)
+    add_next_link(_feed, LIST_CAT, slice_value, items)
     return _feed
 
 
@@ -289,15 +315,17 @@ def list_of_title(slice_value):
 #########################################################
 # Выдача списка книг по наименованию или на основании поискового запроса
 #
-def list_of_title_or_search(slice_value, page_value, search_term):
+def list_of_title_or_search(slice_value, page_value, search_term, after=None, before=None):
     _feed = make_feed()
-    if page_value > 0:
-        add_previous_link(_feed, LIST_TITLE_SEARCH, page_value)
-    letter = letter_from_slice(slice_value) if slice_value >= 0 else "%" + search_term
-    for book in opdsdb.getbooksfortitle(letter, cfg.MAXITEMS, page_value, cfg.DUBLICATES_SHOW):
+    if slice_value >= 0:
+        books = opdsdb.getbooksfortitle(letter_from_slice(slice_value), cfg.MAXITEMS, page_value,
+                                        cfg.DUBLICATES_SHOW, after, before)
+    else:
+        books = opdsdb.searchbooks(search_term, cfg.MAXITEMS, page_value, cfg.DUBLICATES_SHOW, after, before)
+    add_previous_link(_feed, LIST_TITLE_SEARCH, slice_value, books, search_term)
+    for book in books:
         _feed.add(make_book(book))
-    if opdsdb.next_page:
-        add_next_link(_feed, LIST_TITLE_SEARCH, page_value)
+    add_next_link(_feed, LIST_TITLE_SEARCH, slice_value, books, search_term)
     return _feed
 
 
@@ -338,14 +366,13 @@ def list_of_genre_subsections(slice_value):
 #########################################################
 # Выдача списка книг по жанру
 #
-def list_of_subsection(slice_value, page_value):
+def list_of_subsection(slice_value, page_value, after=None, before=None):
     _feed = make_feed()
-    if page_value > 0:
-        add_previous_link(_feed, LIST_SUBSECTION, page_value)
-    for book in opdsdb.getbooksforgenre(slice_value, cfg.MAXITEMS, page_value, cfg.DUBLICATES_SHOW):
+    books = opdsdb.getbooksforgenre(slice_value, cfg.MAXITEMS, page_value, cfg.DUBLICATES_SHOW, after, before)
+    add_previous_link(_feed, LIST_SUBSECTION, slice_value, books)
+    for book in books:
         _feed.add(make_book(book))
-    if opdsdb.next_page:
-        add_next_link(_feed, LIST_SUBSECTION, page_value)
+    add_next_link(_feed, LIST_SUBSECTION, slice_value, books)
     return _feed
 
 
@@ -362,13 +389,12 @@ def list_of_last():
 #########################################################
 # Выдача списка авторов
 #
-def list_authors(slice_value, page_value):
+def list_authors(slice_value, page_value, after=None, before=None):
     _feed = make_feed()
-    if page_value > 0:
-        add_previous_link(_feed, LIST_AUTHOR_CNT, page_value)
     letter = letter_from_slice(slice_value)
-    for (author_id, first_name, last_name, cnt) in opdsdb.getauthorsbyl(letter, cfg.MAXITEMS, page_value,
-                                                                        cfg.DUBLICATES_SHOW):
+    authors = opdsdb.getauthorsbyl(letter, cfg.MAXITEMS, page_value, cfg.DUBLICATES_SHOW, after, before)
+    add_previous_link(_feed, LIST_AUTHOR_CNT, slice_value, authors)
+    for (author_id, first_name, last_name, cnt, search_name) in authors:
         _id = make_href(LIST_BOOK, author_id)
         _entry = pyatom.FeedEntry(title='{:s} {:s}'.format(last_name, first_name),
                                   id='author:{:d}'.format(author_id),
@@ -377,22 +403,20 @@ def list_authors(slice_value, page_value):
         _entry.links.append(Link(_id, rel='alternate').to_dict())
         _entry.links.append(AsqusitionLink(_id, rel='subsection').to_dict())
         _feed.add(_entry)
-    if opdsdb.next_page:
-        add_next_link(_feed, LIST_AUTHOR_CNT, page_value)
+    add_next_link(_feed, LIST_AUTHOR_CNT, slice_value, authors)
     return _feed
 
 
 #########################################################
 # Выдача списка книг по автору
 #
-def list_book_of_author(slice_value, page_value):
+def list_book_of_author(slice_value, page_value, after=None, before=None):
     _feed = make_feed()
-    if page_value > 0:
-        add_previous_link(_feed, LIST_BOOK, page_value)
-    for book in opdsdb.getbooksforauthor(slice_value, cfg.MAXITEMS, page_value, cfg.DUBLICATES_SHOW):
+    books = opdsdb.getbooksforauthor(slice_value, cfg.MAXITEMS, page_value, cfg.DUBLICATES_SHOW, after, before)
+    add_previous_link(_feed, LIST_BOOK, slice_value, books)
+    for book in books:
         _feed.add(make_book(book))
-    if opdsdb.next_page:
-        add_next_link(_feed, LIST_BOOK, page_value)
+    add_next_link(_feed, LIST_BOOK, slice_value, books)
     return _feed
 
 
@@ -416,86 +440,371 @@ def list_of_ref(book_id):
     return _feed
 
 
+def readchunks(f):
+    """
+    Поток читается и отдаётся порциями по OUT_CHUNK байт
+
+    """
+    try:
+        while True:
+            data = f.read(OUT_CHUNK)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+
+def sendfile(environ, f):
+    """
+    Файл на диске отдаёт сервер через wsgi.file_wrapper (sendfile, если он умеет),
+    иначе - порциями по OUT_CHUNK байт
+
+    """
+    wrapper = environ.get('wsgi.file_wrapper')
+    if wrapper is None:
+        return readchunks(f)
+    return wrapper(f, OUT_CHUNK)
+
+
+class FileRange:
+    """
+    Часть файла [start, start + length) как файловый объект: read() не выходит
+    за конец части, fileno() и tell() позволяют серверу отдать её через sendfile
+
+    """
+    def __init__(self, f, start, length):
+        f.seek(start)
+        self.file = f
+        self.left = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+        data = self.file.read(size)
+        self.left -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def byterange(environ, size, last_modified):
+    """
+    Диапазон из заголовка Range: (первый, последний байт) или None - весь файл.
+    Несколько диапазонов, неверный синтаксис и несовпавший If-Range означают весь файл;
+    ValueError - диапазон за концом файла (416)
+
+    """
+    value = environ.get('HTTP_RANGE', '').strip()
+    if not value.startswith('bytes=') or ',' in value:
+        return None
+    if environ.get('HTTP_IF_RANGE', last_modified) != last_modified:
+        return None
+    first, sep, last = (part.strip() for part in value[6:].partition('-'))
+    if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # последние last байт
+        if not last or not int(last) or not size:
+            raise ValueError(value)
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(value)
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def out_range(environ, status, headers, f, offset, size, mtime):
+    """
+    Ответ с поддержкой Range для данных, занимающих size байт с позиции offset файла f:
+    весь файл (200), запрошенная часть (206) или 416
+
+    """
+    last_modified = format_date_time(mtime)
+    headers += [('Accept-Ranges', 'bytes'), ('Last-Modified', last_modified)]
+    try:
+        part = byterange(environ, size, last_modified)
+    except ValueError:
+        f.close()
+        headers += [('Content-Range', 'bytes */{:d}'.format(size)), ('Content-Length', '0')]
+        return '416 Range Not Satisfiable', headers, [b'']
+    start, end = part or (0, size - 1)
+    if part:
+        status = '206 Partial Content'
+        headers.append(('Content-Range', 'bytes {:d}-{:d}/{:d}'.format(start, end, size)))
+    headers.append(('Content-Length', str(end - start + 1)))
+    return status, headers, sendfile(environ, FileRange(f, offset + start, end - start + 1))
+
+
 #########################################################
 # Выдача файла книги
 #
-def out_file_of_book(book_id):
+def out_file_of_book(book_id, environ):
     book = opdsdb.getbook(book_id)
     full_path = os.path.join(cfg.ROOT_LIB, book.path)
+    filename = containerbook(book.filename) if book.cat_gz() else book.filename
     # HTTP Header
     status = '200 OK'
-    headers = [('Content-Type', 'application/octet-stream; name="' + book.filename + '"'),
-               ('Content-Disposition', 'attachment; filename=' + translit(book.filename)),
+    headers = [('Content-Type', 'application/octet-stream; name="' + filename + '"'),
+               ('Content-Disposition', 'attachment; filename=' + translit(filename)),
                ('Content-Transfer-Encoding', 'binary')]
-    buf = ''
-    if book.cat_normal():
+    if book.cat_gz():
+        # сжатая книга распаковывается по мере отдачи; без Content-Length
+        # соединение закрывается после ответа
         file_path = os.path.join(full_path, book.filename)
         if os.path.exists(file_path):
-            book_size = os.path.getsize(file_path.encode('utf-8'))
-            headers.append(('Content-Length', str(book_size)))
-            fo = open(file_path, "rb")
-            buf = fo.read()
-            fo.close()
-        else:
-            status = '404 Not Found'
+            return status, headers, readchunks(opencontainer(file_path))
+        status = '404 Not Found'
+    elif book.cat_normal():
+        file_path = os.path.join(full_path, book.filename)
+        if os.path.exists(file_path):
+            fo = open(file_path, 'rb')
+            stat = os.fstat(fo.fileno())
+            return out_range(environ, status, headers, fo, 0, stat.st_size, stat.st_mtime)
+        status = '404 Not Found'
     elif book.cat_zip():
         if os.path.exists(full_path):
-            z = zipfile.ZipFile(full_path, 'r', allowZip64=True)
-            book_size = z.getinfo(book.filename).file_size
-            headers.append(('Content-Length', str(book_size)))
-            fo = z.open(book.filename)
-            buf = fo.read()
-            fo.close()
-            z.close()
-        else:
-            status = '404 Not Found'
-    return status, headers, buf
+            with zipfile.ZipFile(full_path, 'r', allowZip64=True) as z:
+                info = z.getinfo(book.filename)
+                if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+                    # несжатая книга отдаётся прямо из файла архива, с поддержкой Range
+                    fo = open(full_path, 'rb')
+                    stat = os.fstat(fo.fileno())
+                    return out_range(environ, status, headers, fo, zipdataoffset(fo, info), info.file_size,
+                                     stat.st_mtime)
+                # сжатая книга распаковывается по мере отдачи
+                headers.append(('Content-Length', str(info.file_size)))
+                fo = z.open(book.filename)
+            return status, headers, readchunks(fo)
+        status = '404 Not Found'
+    return status, headers, [b'']
 
 
 #########################################################
 # Выдача файла книги в ZIP формате
 #
-def out_zipfile_of_book(book_id):
+class StreamWriter:
+    """
+    Приёмник для zipfile без seek/tell: zipfile пишет в него последовательно,
+    с дескриптором данных после каждого файла, а готовые порции забираются pop().
+    Всё записанное дублируется в copy (файл кэша), если он задан; после ошибки
+    записи копия прекращается, а failed отмечает, что она неполна.
+
+    """
+    def __init__(self, copy=None):
+        self.chunks = []
+        self.copy = copy
+        self.failed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        if self.copy is not None:
+            try:
+                self.copy.write(data)
+            except OSError as e:
+                logging.warning('ZIP cache: {:s}'.format(str(e)))
+                self.copy = None
+                self.failed = True
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+class ZipCache:
+    """
+    Каталог упакованных в ZIP книг. Файл называется по книге и отпечатку источника,
+    поэтому изменившийся источник упаковывается заново. Общий размер не больше size байт,
+    вытесняются файлы, к которым дольше всего не обращались.
+
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def filename(self, book_id, fingerprint):
+        digest = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.path, '{:d}-{:s}.zip'.format(book_id, digest))
+
+    def open(self, book_id, fingerprint):
+        """
+        Готовый файл из кэша или None
+
+        """
+        path = self.filename(book_id, fingerprint)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning('ZIP cache: {:s}'.format(str(e)))
+            return None
+        # время доступа обновляется явно: ФС может быть смонтирована с noatime
+        try:
+            os.utime(path, (time.time(), os.fstat(f.fileno()).st_mtime))
+        except OSError:
+            pass
+        return f
+
+    def create(self):
+        """
+        Временный файл для записи в кэш или None: кэш необязателен, и ошибка
+        (каталог нельзя создать или записать) не мешает отдаче книги
+
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            return tempfile.NamedTemporaryFile(dir=self.path, suffix='.tmp', delete=False)
+        except OSError as e:
+            logging.warning('ZIP cache: {:s}'.format(str(e)))
+            return None
+
+    def store(self, tmp, book_id, fingerprint):
+        """
+        Записанный файл становится файлом кэша; прежние версии книги удаляются
+
+        """
+        path = self.filename(book_id, fingerprint)
+        os.replace(tmp.name, path)
+        prefix = '{:d}-'.format(book_id)
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(prefix) and entry.name.endswith('.zip') and entry.path != path:
+                self.remove(entry.path)
+        self.trim()
+
+    def discard(self, tmp):
+        self.remove(tmp.name)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def trim(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.zip'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for atime, size, path in entries)
+        for atime, size, path in sorted(entries):
+            if total <= self.size:
+                break
+            self.remove(path)
+            total -= size
+
+
+def zipsource(book, path):
+    """
+    Источник книги для упаковки: (отпечаток, дата для ZIP, размер, функция открытия потока)
+
+    """
+    if book.cat_zip():
+        with zipfile.ZipFile(path, 'r', allowZip64=True) as z:
+            info = z.getinfo(book.filename)
+
+        def opener():
+            with zipfile.ZipFile(path, 'r', allowZip64=True) as z:
+                return z.open(book.filename)
+        fingerprint = '{:s}\0{:08x}\0{:d}'.format(book.filename, info.CRC, info.file_size)
+        return fingerprint, info.date_time, info.file_size, opener
+    stat = os.stat(path)
+    fingerprint = '{:d}\0{:d}\0{:d}'.format(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    date_time = max(time.localtime(stat.st_mtime)[:6], ZIP_MIN_DATE)
+    if book.cat_gz():
+        # размер подсчитан при сканировании распаковкой книги
+        return fingerprint, date_time, book.filesize, lambda: opencontainer(path)
+    return fingerprint, date_time, stat.st_size, lambda: open(path, 'rb')
+
+
+def zipstream(name, date_time, size, opener, cache=None, book_id=0, fingerprint=''):
+    """
+    ZIP с одним файлом name, сжимаемый по мере отдачи: порции сжатых данных
+    отдаются сразу, размеры и CRC пишутся в дескриптор данных после них.
+    Источник открывается opener() при первой порции, так что незапущенный генератор
+    ничего не держит открытым. Если задан cache, полностью отданный архив сохраняется в нём.
+
+    """
+    tmp = cache.create() if cache else None
+    out = StreamWriter(tmp)
+    done = False
+    try:
+        with opener() as source, zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zo:
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.file_size = size   # zipfile решает по нему, нужен ли ZIP64
+            with zo.open(info, 'w') as dest:
+                while True:
+                    data = source.read(OUT_CHUNK)
+                    if not data:
+                        break
+                    dest.write(data)
+                    yield from out.pop()
+        yield from out.pop()
+        done = True
+    finally:
+        if tmp:
+            tmp.close()
+            try:
+                if done and not out.failed:
+                    cache.store(tmp, book_id, fingerprint)
+            except OSError as e:
+                logging.warning('ZIP cache: {:s}'.format(str(e)))
+            finally:
+                cache.discard(tmp)
+
+
+def out_zipfile_of_book(book_id, environ):
     book = opdsdb.getbook(book_id)
     full_path = os.path.join(cfg.ROOT_LIB, book.path)
-    trans_name = translit(book.filename)
+    filename = containerbook(book.filename) if book.cat_gz() else book.filename
+    trans_name = translit(filename)
     # HTTP Header
     status = '200 OK'
-    headers = [('Content-Type', 'application/zip; name="{0:s}"'.format(book.filename)),
+    headers = [('Content-Type', 'application/zip; name="{0:s}"'.format(filename)),
                ('Content-Disposition', 'attachment; filename={0:s}.zip'.format(trans_name)),
                ('Content-Transfer-Encoding', 'binary')]
-    buf = ''
-    dio = io.BytesIO()
-    zo = zipfile.ZipFile(dio, 'w', zipfile.ZIP_DEFLATED)
-    if book.cat_type == sopdsdb.CAT_NORMAL:
-        file_path = os.path.join(full_path, book.filename)
-        if os.path.exists(file_path):
-            zo.write(file_path.encode('utf-8'), trans_name)
-            zo.close()
-            buf = dio.getvalue()
-            headers.append(('Content-Length', str(len(buf))))
-        else:
-            status = '404 Not Found'
-    elif book.cat_type == sopdsdb.CAT_ZIP:
-        if os.path.exists(full_path):
-            z = zipfile.ZipFile(full_path, 'r', allowZip64=True)
-            fo = z.open(book.filename)
-            buf = fo.read()
-            fo.close()
-            z.close()
-            zo.writestr(trans_name, buf)
-            zo.close()
-            buf = dio.getvalue()
-            headers.append(('Content-Length', str(len(buf))))
-        else:
-            status = '404 Not Found'
-    return status, headers, buf
+    file_path = full_path if book.cat_zip() else os.path.join(full_path, book.filename)
+    if not os.path.exists(file_path):
+        return '404 Not Found', headers, [b'']
+    if book.cat_gz() and containerext(book.filename) == '.zip':
+        # книга уже упакована в ZIP - файл отдаётся как есть
+        fo = open(file_path, 'rb')
+        stat = os.fstat(fo.fileno())
+        return out_range(environ, status, headers, fo, 0, stat.st_size, stat.st_mtime)
+    fingerprint, date_time, size, opener = zipsource(book, file_path)
+    cache = ZipCache(cfg.ZIP_CACHE_PATH, cfg.ZIP_CACHE_SIZE * 1048576) if cfg.ZIP_CACHE_SIZE > 0 else None
+    fo = cache.open(book_id, fingerprint) if cache else None
+    if fo is not None:
+        stat = os.fstat(fo.fileno())
+        return out_range(environ, status, headers, fo, 0, stat.st_size, stat.st_mtime)
+    # размер архива заранее неизвестен: без Content-Length, соединение закрывается после ответа
+    return status, headers, zipstream(trans_name, date_time, size, opener, cache, book_id, fingerprint)
 
 
 #########################################################
 # Выдача Обложки На лету
 #
-def get_cover(book_id):
+def get_cover(book_id, environ):
     book = opdsdb.getbook(book_id)
     no_cover = True
     status = '200 OK'
@@ -506,11 +815,14 @@ def get_cover(book_id):
         if book.cat_normal():
             file_path = os.path.join(full_path, book.filename)
             fb2 = FictionBook(file_path)
+        elif book.cat_gz():
+            with opencontainer(os.path.join(full_path, book.filename)) as f:
+                fb2 = FictionBook(f)
         else:
-            z = zipfile.ZipFile(full_path)
-            f = z.open(book.filename)
-            fb2 = FictionBook(f)
-        if fb2.cover is not None:
+            with zipfile.ZipFile(full_path) as z:
+                with z.open(book.filename) as f:
+                    fb2 = FictionBook(f)
+        if fb2.parsed and fb2.cover is not None:
             try:
                 buf = fb2.cover.image
                 ictype = fb2.cover.content_type
@@ -521,56 +833,59 @@ def get_cover(book_id):
 
     if no_cover:
         if os.path.exists(cfg.NOCOVER_IMG):
-            headers = [('Content-Type', 'image/jpeg')]
-            f = open(cfg.NOCOVER_IMG, "rb")
-            buf = f.read()
-            f.close()
-            headers.append(('Content-Length', str(len(buf))))
-        else:
-            status = '404 Not Found'
+            f = open(cfg.NOCOVER_IMG, 'rb')
+            headers = [('Content-Type', 'image/jpeg'), ('Content-Length', str(os.fstat(f.fileno()).st_size))]
+            return status, headers, sendfile(environ, f)
+        status = '404 Not Found'
 
-    return status, headers, buf
+    return status, headers, [buf]
 
 
-def out_file(path):
+def out_file(path, environ):
     status = '200 OK'
     headers = []
     buf = b''
     ictype = mimetypes.guess_type(path)[0]
     if ictype == None:
         status = '404 Not Found'
-        return status, headers, buf
+        return status, headers, [buf]
 
     headers = [('Content-Type', ictype)]
     p, filename = os.path.split(path)
-    if p.strip(os.sep+os.altsep) == 'covers':
+    if p.strip('/') == 'covers':
         full_path = os.path.join(cfg.COVER_PATH, filename)
-    elif p.strip(os.sep+os.altsep) == 'covers/thumbnails':
+    elif p.strip('/') == 'covers/thumbnails':
         full_path = os.path.join(cfg.COVER_PATH, 'thumbnails', filename)
     else:
         full_path = filename
     logging.debug('path: %s, full_path: "%s"' % (p, full_path))
     if os.path.exists(full_path):
         f = open(full_path, 'rb')
-        buf = f.read()
-        f.close()
-        headers.append(('Content-Length', str(len(buf))))
-    else:
-        status = '404 Not Found'
-    return status, headers, buf
+        headers.append(('Content-Length', str(os.fstat(f.fileno()).st_size)))
+        return status, headers, sendfile(environ, f)
+    status = '404 Not Found'
+    return status, headers, [buf]
 
 import pyatom
 
 
 def simple_app(environ, start_response):
+    try:
+        return opds_app(environ, start_response)
+    finally:
+        # сессия потока закрывается после каждого запроса; тела ответов читают только файлы
+        opdsdb.release()
+
+
+def opds_app(environ, start_response):
 
     path_info = environ['PATH_INFO']
     logging.debug('path_info: "%s"' % path_info)
     if path_info != '/':
         logging.debug(path_info)
-        status, headers, buf = out_file(path_info)
+        status, headers, ret = out_file(path_info, environ)
         start_response(status, headers)
-        return [buf]
+        return ret
 
     d = parse_qs(environ['QUERY_STRING'])
     logging.debug(d)
@@ -578,6 +893,8 @@ def simple_app(environ, start_response):
     type_value = 0
     slice_value = 0
     page_value = 0
+    after = None
+    before = None
     search_term = ''
 
     if 'id' in d:
@@ -591,11 +908,14 @@ def simple_app(environ, start_response):
         page = d.get('page', ['0'])[0]
         if page.isdigit():
             page_value = int(page)
+    if 'after' in d:
+        after = cursor_from_str(d['after'][0])
+    if 'before' in d:
+        before = cursor_from_str(d['before'][0])
     if 'search' in d:
         search_term = d.get('search', [''])[0]
         type_value = 10
         slice_value = -1
-        id_value = "10&amp;search=" + search_term
 
     status = '200 OK'
     headers = [('Content-type', 'text/xml; charset=utf-8')]
@@ -603,39 +923,39 @@ def simple_app(environ, start_response):
     if type_value == 0:
         feed = main_menu()
     elif type_value == LIST_CAT:
-        feed = list_of_catalogs(slice_value, page_value)
+        feed = list_of_catalogs(slice_value, page_value, after, before)
     elif type_value == LIST_AUTHORS_CNT:
         feed = list_of_authors(slice_value)
     elif type_value == LIST_TITLE_CNT:
         feed = list_of_title(slice_value)
     elif type_value == LIST_TITLE_SEARCH:
-        feed = list_of_title_or_search(slice_value, page_value, search_term)
+        feed = list_of_title_or_search(slice_value, page_value, search_term, after, before)
     elif type_value == LIST_GENRE_CNT:
         feed = list_of_genre()
     elif type_value == LIST_GENRE_SUB_CNT:
         feed = list_of_genre_subsections(slice_value)
     elif type_value == LIST_SUBSECTION:
-        feed = list_of_subsection(slice_value, page_value)
+        feed = list_of_subsection(slice_value, page_value, after, before)
     elif type_value == LIST_LAST:
         feed = list_of_last()
     elif type_value == LIST_AUTHOR_CNT:
-        feed = list_authors(slice_value, page_value)
+        feed = list_authors(slice_value, page_value, after, before)
     elif type_value == LIST_BOOK:
-        feed = list_book_of_author(slice_value, page_value)
+        feed = list_book_of_author(slice_value, page_value, after, before)
     elif type_value == BOOK:
         feed = list_of_ref(slice_value)
     elif type_value == OUT_BOOK:
-        status, headers, ret = out_file_of_book(slice_value)
+        status, headers, ret = out_file_of_book(slice_value, environ)
         start_response(status, headers)
-        return [ret]
+        return ret
     elif type_value == OUT_ZIP_BOOK:
-        status, headers, ret = out_zipfile_of_book(slice_value)
+        status, headers, ret = out_zipfile_of_book(slice_value, environ)
         start_response(status, headers)
-        return [ret]
+        return ret
     elif type_value == OUT_COVER:
-        status, headers, ret = get_cover(slice_value)
+        status, headers, ret = get_cover(slice_value, environ)
         start_response(status, headers)
-        return [ret]
+        return ret
     else:
         feed = make_feed()
 
@@ -644,15 +964,37 @@ def simple_app(environ, start_response):
     return [feed.to_bytestring()]
 
 
-if __name__ == '__main__':
-    logging.basicConfig(filename='server.log', level=logging.DEBUG)
-
+def open_db():
+    global opdsdb
     opdsdb = sopdsdb.opdsDatabase(cfg.ENGINE + cfg.DB_NAME, cfg.DB_USER, cfg.DB_PASS, cfg.DB_HOST, cfg.ROOT_LIB)
-    opdsdb.open_db()
+    opdsdb.open_db(pool_size=cfg.SERVER_THREADS)
 
-    validator_app = validator(simple_app)
-    httpd = make_server('', cfg.PORT, validator_app)
-    print('Serving on port {0:d}...'.format(cfg.PORT))
-    httpd.serve_forever()
 
-    opdsdb.close_db()
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Simple OPDS Server - OPDS catalog of your e-book library.')
+    parser.add_argument('-p', '--port', help='Port to listen', type=int, default=cfg.PORT)
+    parser.add_argument('-t', '--threads', help='Threads serving connections (per worker)', type=int,
+                        default=cfg.SERVER_THREADS)
+    parser.add_argument('-w', '--workers', help='Worker processes sharing the socket, 0 - single process',
+                        type=int, default=cfg.SERVER_WORKERS)
+    parser.add_argument('--max-requests', help='Requests before a worker process is restarted, 0 - never',
+                        type=int, default=cfg.SERVER_MAX_REQUESTS)
+    parser.add_argument('--keepalive', help='Seconds to keep idle connection open, 0 - no keep-alive',
+                        type=float, default=cfg.SERVER_KEEPALIVE)
+    parser.add_argument('-d', '--debug', help='Debug log and WSGI validator', action='store_true',
+                        default=cfg.DEBUG)
+    parser.add_argument('-v', '--verbose', help='Log requests to stderr', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='server.log', level=logging.DEBUG if args.debug else logging.WARNING)
+    cfg.SERVER_THREADS = args.threads
+
+    app = validator(simple_app) if args.debug else simple_app
+    print('Serving on port {0:d}...'.format(args.port))
+    # в режиме prefork каждый процесс открывает свою БД после fork
+    httpd.serve(app, '', args.port, args.workers, args.threads, args.keepalive, args.max_requests, args.verbose,
+                open_db)
+    if args.workers <= 0:
+        opdsdb.close_db()
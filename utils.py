@@ -1,19 +1,37 @@
 __author__ = 'vseklecov'
 
-import base64
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import errno
+import gzip
+import hashlib
 import inspect
+import io
+import json
 import mimetypes
+import multiprocessing
 import os
 import PIL.Image
+import queue
+import struct
+import sys
+import threading
 import time
 import xml.etree.ElementTree as ET
 import zipfile
 
 import db as opdsdb
+from fb2parser import FB2Stream
 
 PY_PATH = os.path.split(os.path.abspath(inspect.getsourcefile(lambda _: None)))[0]
 VERBOSE = False
+WATCH_BATCH = 100   # путей, обрабатываемых за один проход в режиме --watch
+COVER_QUEUE = 64    # обложек в очереди на обработку
+HASH_CHUNK = 1024 * 1024  # порция чтения при подсчёте хэша файла книги
+CONTAINERS = ('.fb2.gz', '.fb2.zip')    # сжатые файлы одной книги (CAT_GZ)
+PROGRESS_INTERVAL = 10  # секунд между строками прогресса сканирования
 
 class CfgReader:
 
@@ -26,7 +44,12 @@ class CfgReader:
 
         self.NAME = self.config.get(self.CFG_G, 'name', fallback='Simple OPDS Catalog')
         self.ROOT_URL = self.config.get(self.CFG_G, 'root_url', fallback='http://home/')
-        self.PORT = self.config.get(self.CFG_G, 'port', fallback=8000)
+        self.PORT = self.config.getint(self.CFG_G, 'port', fallback=8000)
+        self.SERVER_THREADS = self.config.getint(self.CFG_G, 'server_threads', fallback=8)
+        self.SERVER_WORKERS = self.config.getint(self.CFG_G, 'server_workers', fallback=0)
+        self.SERVER_MAX_REQUESTS = self.config.getint(self.CFG_G, 'server_max_requests', fallback=1000)
+        self.SERVER_KEEPALIVE = self.config.getfloat(self.CFG_G, 'server_keepalive', fallback=5)
+        self.DEBUG = self.config.getboolean(self.CFG_G, 'debug', fallback=False)
 
         self.ENGINE = self.config.get(self.CFG_G, 'engine', fallback='sqlite:///')
         self.DB_NAME = self.config.get(self.CFG_G, 'db_name', fallback=os.path.join(PY_PATH, 'db', 'sopds.db'))
@@ -40,6 +63,7 @@ class CfgReader:
         self.FORMATS = self.config.get(self.CFG_G, 'formats', fallback='.pdf .djvu .fb2 .txt')
         self.DUBLICATES_FIND = self.config.getboolean(self.CFG_G, 'dublicates_find', fallback=True)
         self.DUBLICATES_SHOW = self.config.getboolean(self.CFG_G, 'dublicates_show', fallback=False)
+        self.DUBLICATES_HASH = self.config.getboolean(self.CFG_G, 'dublicates_hash', fallback=False)
         self.FB2PARSE = self.config.getboolean(self.CFG_G, 'fb2parse', fallback=True)
         self.ZIPSCAN = self.config.getboolean(self.CFG_G, 'zipscan', fallback=True)
         self.ZIPRESCAN = self.config.getboolean(self.CFG_G, 'ziprescan', fallback=False)
@@ -47,11 +71,21 @@ class CfgReader:
         self.LAST_SCAN = self.config.getfloat(self.CFG_G, 'last_scan', fallback=time.time())
 
         self.FB2HSIZE = self.config.getint(self.CFG_G, 'fb2hsize', fallback=0)
+        self.BATCH_SIZE = self.config.getint(self.CFG_G, 'batch_size', fallback=opdsdb.BATCH_SIZE)
+        self.CACHE_SIZE = self.config.getint(self.CFG_G, 'cache_size', fallback=opdsdb.CACHE_SIZE)
+        self.WATCH_DELAY = self.config.getfloat(self.CFG_G, 'watch_delay', fallback=5)
+        self.WATCH_INTERVAL = self.config.getfloat(self.CFG_G, 'watch_interval', fallback=60)
+        self.COVER_THREADS = self.config.getint(self.CFG_G, 'cover_threads', fallback=2)
+        self.WALK_THREADS = self.config.getint(self.CFG_G, 'walk_threads', fallback=4)
         self.MAXITEMS = self.config.getint(self.CFG_G, 'maxitems', fallback=50)
         self.SPLITAUTHORS = self.config.getint(self.CFG_G, 'splitauthors', fallback=300)
         self.SPLITTITLES = self.config.getint(self.CFG_G, 'splittitles', fallback=300)
         self.COVER_SHOW = self.config.getint(self.CFG_G, 'cover_show', fallback=0)
         self.COVER_THUMBNAIL_SIZE = self.config.getint(self.CFG_G, 'cover_thumbnail_size', fallback=144)
+        self.NOCOVER_IMG = self.config.get(self.CFG_G, 'nocover_img', fallback=os.path.join(PY_PATH, 'nocover.jpg'))
+        self.ZIP_CACHE_PATH = os.path.abspath(self.config.get(self.CFG_G, 'zip_cache_path',
+                                                              fallback=os.path.join(PY_PATH, 'cache')))
+        self.ZIP_CACHE_SIZE = self.config.getint(self.CFG_G, 'zip_cache_size', fallback=256)    # Мб, 0 - без кэша
         zip_codepage = self.config.get(self.CFG_G, 'zip_codepage', fallback='cp866')
 
         if self.COVER_EXTRACT:
@@ -90,6 +124,7 @@ class Author:
         first_name = author.findtext(ET.QName(ns, 'first-name').text, '').strip(' \'\"\&()-.#[]\\\`')
         nickname = author.findtext(ET.QName(ns, 'nickname').text, '').strip(' \'\"\&()-.#[]\\\`')
         if (len(last_name) + len(first_name)) == 0:
+            self.first_name = ''
             self.last_name = nickname
         else:
             self.first_name = first_name
@@ -97,145 +132,951 @@ class Author:
 
 
 class Image:
-    def __init__(self, root, image):
+    def __init__(self, stream, image):
         _id = image.get('{http://www.w3.org/1999/xlink}href')
         self.content_type = ''
-        if _id[0] == '#':
-            binary = root.find("*/[@id='{:s}']".format(_id[1:]))
-            if binary != None:
-                self.content_type = binary.get('content-type').lower()
-                self.image = base64.b64decode(binary.text)
+        if _id and _id[0] == '#':
+            binary = stream.binary(_id[1:])
+            if binary is not None:
+                self.content_type = binary[0].lower()
+                self.image = binary[1]
 
 
 class FictionBook:
 
-    def __init__(self, filename):
-        if isinstance(filename, str):
-            if os.path.exists(filename):
-                try:
-                    self.tree = ET.parse(filename)
-                    self.root = self.tree.getroot()
-                    self.parsed = True
-                except ET.ParseError:
-                    self.parsed = False
-            else:
-                self.parsed = False
-        elif hasattr(filename, 'read'):
+    def __init__(self, filename, hsize=0, cover=True):
+        if isinstance(filename, str) and os.path.exists(filename) or hasattr(filename, 'read'):
+            stream = FB2Stream(filename, hsize)
             try:
-                self.root = ET.fromstring(filename.read())
-                self.parsed = True
+                desc = stream.description()
+                self.parsed = desc is not None
             except ET.ParseError:
                 self.parsed = False
         else:
+            stream = None
             self.parsed = False
-        if self.parsed:
-            ns = self.root.tag.split('}')[0][1:]
-            desc = self.root.find(ET.QName(ns, 'description').text)
-            ti = desc.find(ET.QName(ns, 'title-info').text)
-            self.genres = []
-            for genre in ti.iter(ET.QName(ns, 'genre').text):
-                self.genres.append(genre.text.lower().strip(' \'\"\&()-.#[]\\\`'))
-            self.authors = [Author(author) for author in ti.iter(ET.QName(ns, 'author').text)]
-            self.lang = ti.findtext(ET.QName(ns, 'lang').text, 'ru').strip(' \'\"')
-            self.title = ti.findtext(ET.QName(ns, 'book-title').text, '').strip(' \'\"\&()-.#[]\\\`')
-            annotation = ti.find(ET.QName(ns, 'annotation').text)
-            if annotation:
-                self.annotation = ET.tostring(annotation, 'unicode', 'text')
-            else:
-                self.annotation = ''
-            coverpage = ti.find(ET.QName(ns, 'coverpage').text)
-            self.cover = None
-            if coverpage is not None:
-                image = coverpage.find(ET.QName(ns, 'image').text)
-                if image is not None:
-                    self.cover = Image(self.root, image)
-            sequence = ti.find(ET.QName(ns, 'sequence').text)
-            if sequence is not None:
-                self.name_sequence = sequence.get('name')
-                self.number_in_seq = sequence.get('number')
-            else:
-                self.name_sequence = ''
+        try:
+            if self.parsed:
+                self.root = stream.root
+                ns = self.root.tag.split('}')[0][1:]
+                ti = desc.find(ET.QName(ns, 'title-info').text)
+                self.genres = []
+                for genre in ti.iter(ET.QName(ns, 'genre').text):
+                    self.genres.append(genre.text.lower().strip(' \'\"\&()-.#[]\\\`'))
+                self.authors = [Author(author) for author in ti.iter(ET.QName(ns, 'author').text)]
+                self.lang = ti.findtext(ET.QName(ns, 'lang').text, 'ru').strip(' \'\"')
+                self.title = ti.findtext(ET.QName(ns, 'book-title').text, '').strip(' \'\"\&()-.#[]\\\`')
+                annotation = ti.find(ET.QName(ns, 'annotation').text)
+                if annotation:
+                    self.annotation = ET.tostring(annotation, 'unicode', 'text')
+                else:
+                    self.annotation = ''
+                coverpage = ti.find(ET.QName(ns, 'coverpage').text)
+                self.cover = None
+                if coverpage is not None and cover:
+                    image = coverpage.find(ET.QName(ns, 'image').text)
+                    if image is not None:
+                        self.cover = Image(stream, image)
+                sequence = ti.find(ET.QName(ns, 'sequence').text)
+                if sequence is not None:
+                    self.name_sequence = sequence.get('name')
+                    self.number_in_seq = sequence.get('number')
+                else:
+                    self.name_sequence = ''
+        finally:
+            if stream:
+                stream.close()
 
 
-def processzip(db, path, zip_filename, cfg):
-    rel_path = os.path.relpath(path, cfg.ROOT_LIB)
-    rel_file = os.path.join(rel_path, zip_filename)
+##########################################################################
+# Статистика сканирования: время по этапам, счётчики и прогресс.
+# Время этапов суммируется по всем потокам и процессам, поэтому при
+# --jobs и cover_threads сумма может превышать общее время работы
+#
+class ScanStats:
+
+    STAGES = ('walk', 'zip', 'parse', 'lookup', 'write', 'cover', 'thumbnail')
+    COUNTERS = ('files', 'zips', 'books', 'bytes', 'covers', 'skipped', 'errors')
+
+    def __init__(self, interval=0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.last_progress = self.started
+        self.times = dict.fromkeys(self.STAGES, 0.0)
+        self.counts = collections.Counter(dict.fromkeys(self.COUNTERS, 0))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addtime(name, time.perf_counter() - started)
+
+    def addtime(self, name, seconds):
+        with self.lock:
+            self.times[name] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def walk(self, walker):
+        """
+        Обход каталогов (scantree) с учётом его времени в этапе walk
+
+        """
+        while True:
+            with self.stage('walk'):
+                item = next(walker, None)
+            if item is None:
+                return
+            yield item
+
+    def progress(self):
+        now = time.time()
+        if not self.interval or now - self.last_progress < self.interval:
+            return
+        self.last_progress = now
+        elapsed = max(now - self.started, 1e-6)
+        print('Books: {:d} ({:.1f}/s), {:.1f} MB ({:.2f} MB/s), skipped: {:d}, errors: {:d}'.format(
+            self.counts['books'], self.counts['books'] / elapsed, self.counts['bytes'] / 1048576,
+            self.counts['bytes'] / 1048576 / elapsed, self.counts['skipped'], self.counts['errors']), flush=True)
+
+    def report(self):
+        elapsed = time.time() - self.started
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'elapsed': round(elapsed, 3),
+                'counts': dict(self.counts),
+                'times': {name: round(seconds, 3) for (name, seconds) in self.times.items()},
+                'books_per_sec': round(self.counts['books'] / elapsed, 2) if elapsed else 0,
+                'mb_per_sec': round(self.counts['bytes'] / 1048576 / elapsed, 3) if elapsed else 0}
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+STATS = ScanStats()
+
+
+def processzip(db, path, zip_filename, cfg, members=None, covers=None, done=None):
+    """
+    Разбор книг ZIP архива (или только книг members).
+    done(архив, книга) вызывается после записи каждой книги.
+
+    """
     path_file = os.path.join(path, zip_filename)
-    if cfg.ZIPRESCAN or dbase.zipisscanned(rel_file) == 0:
-        z = zipfile.ZipFile(path_file, 'r', allowZip64=True)
-        file_list = z.namelist()
+    rel_file = os.path.relpath(path_file, cfg.ROOT_LIB)
+    with STATS.stage('lookup'):
+        scanned = members is None and not cfg.ZIPRESCAN and db.zipisscanned(rel_file) != 0
+    if not scanned:
+        with STATS.stage('zip'):
+            z = zipfile.ZipFile(path_file, 'r', allowZip64=True)
+            file_list = z.namelist() if members is None else members
+        STATS.count('zips')
         if VERBOSE:
             print('Start process ZIPped file: {:s}'.format(zip_filename))
         for filename in file_list:
             try:
-                processfile(db, path_file, filename, cfg, archive=z)
+                processfile(db, path_file, filename, cfg, archive=z, covers=covers)
             except:
+                STATS.count('errors')
                 print('Error processing zip archive:', zip_filename, ' file: ', filename)
+            if done:
+                done(rel_file, filename)
         z.close()
     else:
+        STATS.count('skipped')
         if VERBOSE:
             print('Skip ZIP archive: ', rel_file, '. Already scanned.')
 
 
-def processfile(db, path, filename, cfg, archive=None):
+def processfile(db, path, filename, cfg, archive=None, covers=None):
     rel_path = os.path.relpath(path, cfg.ROOT_LIB)
-    if not db.findbook(filename, rel_path):
-        cat_id = db.addcattree(rel_path, 1 if archive else 0)
-        ext = os.path.splitext(filename)[1].lower()
-        if ext == '.fb2' and cfg.FB2PARSE:
-            if archive:
-                fb = FictionBook(archive.open(filename))
-                file_size = archive.getinfo(filename).file_size
-            else:
-                full_path = os.path.join(path, filename)
-                file_size = os.path.getsize(full_path)
-                fb = FictionBook(full_path)
-            book = db.addbook(filename, rel_path, cat_id, ext, fb.title, fb.lang, file_size, 1 if archive else 0,
-                                    cfg.DUBLICATES_FIND, fb.annotation)
-            if VERBOSE:
-                print('Add file: {:s} {:s}'.format(path, filename))
-            for author in fb.authors:
-                author = dbase.addauthor(author.first_name, author.last_name)
-                db.addbauthor(book.book_id, author.author_id)
-            for genre in fb.genres:
-                db.addbgenre(book.book_id, dbase.addgenre(genre).genre_id)
-            if cfg.COVER_EXTRACT and fb.cover:
-                ext = mimetypes.guess_extension(fb.cover.content_type)
-                if ext:
-                    fn = str(book.book_id) + ext
-                    fp = os.path.join(cfg.COVER_PATH, fn)
-                    fp_thubnail = os.path.join(cfg.COVER_PATH, 'thumbnails', fn)
-                    img = open(fp, 'wb')
-                    img.write(fb.cover.image)
-                    img.close()
-                    image = PIL.Image.open(fp)
-                    image.thumbnail((cfg.COVER_THUMBNAIL_SIZE, cfg.COVER_THUMBNAIL_SIZE))
-                    image.save(fp_thubnail)
-                    db.addcover(book.book_id, fn, fb.cover.content_type)
-                    if VERBOSE:
-                        print('Add cover: {}'.format(fp))
+    with STATS.stage('lookup'):
+        book = db.findbook(filename, rel_path)
+    if not book:
+        with STATS.stage('parse'):
+            fb, file_size = readbook(path, filename, cfg, archive)
+        storebook(db, path, filename, cfg, fb, file_size, 1 if archive else 0, covers)
     else:
+        STATS.count('skipped')
         if VERBOSE:
             print('Skip file: ', filename, '. Already scanned.')
 
 
+def filestate(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def entrystate(entry):
+    st = entry.stat()
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def isunder(rel_path, rel_dir):
+    return rel_dir == '.' or rel_path == rel_dir or rel_path.startswith(rel_dir + os.sep)
+
+
+def checkroot(root):
+    """
+    Корень библиотеки должен существовать и читаться: иначе (не смонтированный
+    или недоступный каталог) инкрементальное сканирование сочло бы удалёнными все книги
+
+    """
+    if not os.path.isdir(root):
+        raise OSError(errno.ENOENT, 'Library root is not a directory', root)
+    if not os.access(root, os.R_OK | os.X_OK):
+        raise OSError(errno.EACCES, 'Library root is not readable', root)
+
+
+##########################################################################
+# Обход дерева библиотеки: каталоги читаются os.scandir в пуле потоков
+# (на сетевых ФС обход упирается в задержки, а не в процессор),
+# файлы отбираются по имени до любых других действий, а stat выполняется
+# там же, в потоке пула, и сохраняется в DirEntry
+#
+def listdir(path, accept):
+    """
+    Чтение каталога: (path, отобранные файлы, подкаталоги, ошибки отдельных записей).
+    Ошибка чтения самого каталога не перехватывается - каталог не считается пустым
+
+    """
+    files = []
+    dirs = []
+    errors = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif accept(entry.name) and entry.is_file():
+                        entry.stat()
+                        files.append(entry)
+                except OSError as e:
+                    e.filename = e.filename or entry.path
+                    errors.append(e)
+    except OSError as e:
+        e.filename = e.filename or path
+        raise
+    return path, files, dirs, errors
+
+
+def scantree(top, accept, threads=4, onerror=None):
+    """
+    Генератор (каталог, список DirEntry отобранных файлов) по всему дереву top.
+    Каталоги выдаются в ширину; вперёд читается не больше threads * 4 каталогов.
+    Ошибки чтения каталогов и записей передаются в onerror(OSError), как в os.walk;
+    без onerror обход прерывается исключением.
+
+    """
+    threads = max(threads, 1)
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        dirs = collections.deque([top])
+        futures = collections.deque()
+        while dirs or futures:
+            while dirs and len(futures) < threads * 4:
+                futures.append(pool.submit(listdir, dirs.popleft(), accept))
+            try:
+                path, files, subdirs, errors = futures.popleft().result()
+            except OSError as e:
+                if onerror is None:
+                    raise
+                onerror(e)
+                continue
+            for e in errors:
+                if onerror is None:
+                    raise e
+                onerror(e)
+            dirs.extend(subdirs)
+            yield path, files
+
+
+##########################################################################
+# Сжатые файлы одной книги: name.fb2.gz и name.fb2.zip (архив с одной книгой).
+# В БД такая книга - CAT_GZ: path - каталог, filename - имя сжатого файла
+#
+def containerext(filename):
+    """
+    '.gz' или '.zip' для сжатого файла одной книги, иначе ''
+
+    """
+    name = filename.lower()
+    for ext in CONTAINERS:
+        if name.endswith(ext):
+            return os.path.splitext(ext)[1]
+    return ''
+
+
+def containerbook(filename):
+    """
+    Имя книги в сжатом файле: name.fb2.gz -> name.fb2
+
+    """
+    ext = containerext(filename)
+    return filename[:-len(ext)] if ext else filename
+
+
+def containermember(z):
+    names = [name for name in z.namelist() if not name.endswith('/')]
+    fb2_names = [name for name in names if name.lower().endswith('.fb2')]
+    return (fb2_names or names)[0]
+
+
+def opencontainer(path):
+    """
+    Поток с содержимым книги; распаковывается по мере чтения
+
+    """
+    if containerext(path) == '.gz':
+        return gzip.open(path, 'rb')
+    with zipfile.ZipFile(path, 'r', allowZip64=True) as z:
+        return z.open(containermember(z))
+
+
+def zipmembers(path):
+    """
+    Состав ZIP архива по центральному каталогу: список (имя, CRC32, размер)
+
+    """
+    with STATS.stage('zip'), zipfile.ZipFile(path, 'r', allowZip64=True) as z:
+        return [(info.filename, info.CRC, info.file_size) for info in z.infolist()
+                if not info.filename.endswith('/')]
+
+
+def zipdataoffset(f, info):
+    """
+    Смещение данных члена ZIP архива в файле архива f: за локальным заголовком,
+    длина имени и дополнительного поля в котором может отличаться от центрального каталога
+
+    """
+    f.seek(info.header_offset)
+    header = f.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile('Bad local file header: {:s}'.format(info.filename))
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+def zipdigest(members):
+    digest = hashlib.sha1()
+    for (name, crc, size) in members:
+        digest.update('{:s}\0{:d}\0{:d}\n'.format(name, crc, size).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def filehash(f):
+    digest = hashlib.blake2b(digest_size=20)
+    for data in iter(lambda: f.read(HASH_CHUNK), b''):
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def readbook(path, filename, cfg, archive=None):
+    """
+    Разбор файла книги (без обращения к БД).
+    Возвращает (FictionBook, размер файла); для не-fb2 файлов - (None, 0)
+    При dublicates_hash в fb.filehash записывается хэш содержимого файла.
+
+    """
+    container = not archive and containerext(filename)
+    ext = os.path.splitext(containerbook(filename) if container else filename)[1].lower()
+    if ext != '.fb2' or not cfg.FB2PARSE:
+        return None, 0
+    if archive:
+        fb = FictionBook(archive.open(filename), cfg.FB2HSIZE, cfg.COVER_EXTRACT)
+        file_size = archive.getinfo(filename).file_size
+        opener = lambda: archive.open(filename)
+    elif container:
+        full_path = os.path.join(path, filename)
+        # разбирается только заголовок (и обложка, если она нужна), а размер книги
+        # считается распаковкой до конца: ISIZE в конце gzip неверен для файла
+        # из нескольких членов и для книг больше 4 ГиБ
+        with opencontainer(full_path) as f:
+            fb = FictionBook(f, cfg.FB2HSIZE, cfg.COVER_EXTRACT)
+            file_size = f.seek(0, os.SEEK_END)
+        opener = lambda: opencontainer(full_path)
+    else:
+        full_path = os.path.join(path, filename)
+        file_size = os.path.getsize(full_path)
+        fb = FictionBook(full_path, cfg.FB2HSIZE, cfg.COVER_EXTRACT)
+        opener = lambda: open(full_path, 'rb')
+    fb.filehash = None
+    if cfg.DUBLICATES_FIND and cfg.DUBLICATES_HASH:
+        with opener() as f:
+            fb.filehash = filehash(f)
+    return fb, file_size
+
+
+def storebook(db, path, filename, cfg, fb, file_size, archive=0, covers=None):
+    """
+    Запись в БД книги, разобранной readbook.
+    Обложка передаётся в covers (CoverPool), а без него записывается сразу.
+
+    """
+    rel_path = os.path.relpath(path, cfg.ROOT_LIB)
+    container = not archive and containerext(filename)
+    with STATS.stage('write'):
+        cat_id = db.addcattree(rel_path, archive)
+        if fb is None:
+            return
+        if not fb.parsed:
+            STATS.count('errors')
+            print('Error parsing FB2 header:', os.path.join(rel_path, filename))
+            return
+        if container:
+            archive = opdsdb.CAT_GZ
+        ext = os.path.splitext(containerbook(filename))[1].lower()
+        book = db.addbook(filename, rel_path, cat_id, ext, fb.title, fb.lang, file_size, archive,
+                          cfg.DUBLICATES_FIND, fb.annotation, fb.filehash)
+        if VERBOSE:
+            print('Add file: {:s} {:s}'.format(path, filename))
+        for author in fb.authors:
+            db.addbauthor(book.book_id, db.getauthor_id(author.first_name, author.last_name))
+        for genre in fb.genres:
+            db.addbgenre(book.book_id, db.getgenre_id(genre))
+    STATS.count('books')
+    STATS.count('bytes', file_size)
+    STATS.progress()
+    if cfg.COVER_EXTRACT and fb.cover:
+        if covers is not None:
+            covers.add(book.book_id, fb.cover)
+        else:
+            fn = savecover(cfg, book.book_id, fb.cover)
+            if fn:
+                db.addcover(book.book_id, fn, fb.cover.content_type)
+
+
+def writefile(path, data):
+    # запись через временный файл, чтобы сервер не отдал недописанную обложку
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def savecover(cfg, book_id, cover):
+    """
+    Запись обложки и её миниатюры. Возвращает имя файла обложки или None
+
+    """
+    ext = mimetypes.guess_extension(cover.content_type)
+    if not ext:
+        return None
+    fn = str(book_id) + ext
+    fp = os.path.join(cfg.COVER_PATH, fn)
+    fp_thumbnail = os.path.join(cfg.COVER_PATH, 'thumbnails', fn)
+    with STATS.stage('cover'):
+        writefile(fp, cover.image)
+    with STATS.stage('thumbnail'):
+        size = (cfg.COVER_THUMBNAIL_SIZE, cfg.COVER_THUMBNAIL_SIZE)
+        image = PIL.Image.open(io.BytesIO(cover.image))
+        # для JPEG декодер сразу уменьшает изображение в 2-8 раз
+        image.draft(image.mode, size)
+        image.thumbnail(size)
+        tmp_path = os.path.join(os.path.dirname(fp_thumbnail), '.' + fn)
+        image.save(tmp_path)
+        os.replace(tmp_path, fp_thumbnail)
+    STATS.count('covers')
+    if VERBOSE:
+        print('Add cover: {}'.format(fp))
+    return fn
+
+
+class CoverPool:
+    """
+    Извлечение обложек в отдельных потоках. Очередь ограничена, так что сканер
+    ждёт, только если обложки не успевают обрабатываться; результаты
+    записываются в БД основным потоком пачками через addcovers.
+    Перед фиксацией пакета в БД (flush_batch) очередь дорабатывается, так что
+    зафиксированные книги не остаются без обложек.
+
+    """
+    def __init__(self, db, cfg, threads=2):
+        self.db = db
+        self.cfg = cfg
+        self.queue = queue.Queue(COVER_QUEUE)
+        self.results = queue.Queue()
+        self.threads = [threading.Thread(target=self.work, daemon=True) for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+        db.flush_hooks.append(self.sync)
+
+    def add(self, book_id, cover):
+        self.queue.put((book_id, cover))
+        if self.results.qsize() >= COVER_QUEUE:
+            self.store()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            book_id, cover = item
+            try:
+                fn = savecover(self.cfg, book_id, cover)
+            except Exception as e:
+                STATS.count('errors')
+                print('Error processing cover of book', book_id, ':', e)
+                fn = None
+            if fn:
+                self.results.put((book_id, fn, cover.content_type))
+            self.queue.task_done()
+
+    def sync(self):
+        self.queue.join()
+        self.store()
+
+    def store(self):
+        covers = []
+        while True:
+            try:
+                covers.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        with STATS.stage('write'):
+            self.db.addcovers(covers)
+
+    def close(self):
+        self.db.flush_hooks.remove(self.sync)
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.store()
+
+
+##########################################################################
+# Параллельное сканирование: fb2 разбираются в пуле процессов,
+# а результаты в исходном порядке записываются в БД основным процессом
+#
+worker_cfg = None
+worker_zip = None
+
+
+def initworker(cfg_filename):
+    global worker_cfg
+    worker_cfg = CfgReader(cfg_filename)
+
+
+def parsetask(task):
+    """
+    Разбор одной книги в рабочем процессе. task = (path, filename, in_zip)
+    Возвращает (task, fb, file_size, error, время разбора)
+
+    """
+    global worker_zip
+    path, filename, in_zip = task
+    started = time.perf_counter()
+    try:
+        archive = None
+        if in_zip:
+            if worker_zip is None or worker_zip.filename != path:
+                if worker_zip is not None:
+                    worker_zip.close()
+                worker_zip = zipfile.ZipFile(path, 'r', allowZip64=True)
+            archive = worker_zip
+        fb, file_size = readbook(path, filename, worker_cfg, archive)
+        if fb is not None:
+            # дерево документа обратно в основной процесс не передаём
+            fb.root = fb.tree = None
+        return task, fb, file_size, None, time.perf_counter() - started
+    except Exception as e:
+        return task, None, 0, e, time.perf_counter() - started
+
+
+class Scanner:
+    """
+    Сканирование библиотеки: обход каталогов, запись книг и состояния файлов в БД
+
+    """
+    def __init__(self, db, cfg, covers=True):
+        self.db = db
+        self.cfg = cfg
+        self.ext_set = set(cfg.EXT_LIST)
+        suffixes = set(self.ext_set)
+        if cfg.ZIPSCAN:
+            suffixes.add('.zip')
+        if '.fb2' in self.ext_set:
+            suffixes.update(CONTAINERS)
+        self.suffixes = tuple(suffixes)
+        if covers and cfg.COVER_EXTRACT and cfg.COVER_THREADS > 0:
+            self.covers = CoverPool(db, cfg, cfg.COVER_THREADS)
+        else:
+            self.covers = None
+        self.checkpoints = False
+
+    def processzip(self, path, zip_filename, members=None):
+        processzip(self.db, path, zip_filename, self.cfg, members, self.covers, self.checkpoint)
+
+    def processfile(self, path, filename):
+        processfile(self.db, path, filename, self.cfg, covers=self.covers)
+
+    def addfilestate(self, path, size, mtime, inode):
+        with STATS.stage('write'):
+            self.db.addfilestate(path, size, mtime, inode)
+
+    def addzipstate(self, path, size, mtime, inode, members):
+        with STATS.stage('write'):
+            self.db.addzipmembers(path, members)
+            self.db.addfilestate(path, size, mtime, inode, zipdigest(members))
+
+    ##########################################################################
+    # Отметки о ходе полного сканирования: последний записанный файл или книга архива.
+    # Пишутся в БД вместе с книгами, так что после сбоя --resume продолжает с места отметки
+    #
+    def checkpoint(self, path, member=''):
+        if self.checkpoints:
+            self.db.setcheckpoint('scanall', path, member)
+
+    def endcheckpoints(self):
+        self.checkpoints = False
+        self.db.delcheckpoint('scanall')
+
+    def flush(self):
+        if self.covers:
+            self.covers.store()
+        if self.db.batch_size:
+            with STATS.stage('write'):
+                self.db.flush_batch()
+
+    def close(self):
+        if self.covers:
+            self.covers.close()
+        self.flush()
+
+    def process(self, path, filename):
+        ext = os.path.splitext(filename)[1].lower()
+        if self.iszip(filename):
+            self.processzip(path, filename)
+        elif self.iscontainer(filename) or ext in self.ext_set:
+            self.processfile(path, filename)
+        else:
+            return False
+        STATS.count('files')
+        return True
+
+    def islibfile(self, filename):
+        return filename.lower().endswith(self.suffixes)
+
+    def iszip(self, filename):
+        return self.cfg.ZIPSCAN and os.path.splitext(filename)[1].lower() == '.zip' and not self.iscontainer(filename)
+
+    def iscontainer(self, filename):
+        return bool(containerext(filename)) and '.fb2' in self.ext_set
+
+    def savestate(self, path, filename, state=None):
+        file_path = os.path.join(path, filename)
+        rel_file = os.path.relpath(file_path, self.cfg.ROOT_LIB)
+        state = state or filestate(file_path)
+        if self.iszip(filename):
+            self.addzipstate(rel_file, *state, members=zipmembers(file_path))
+        else:
+            self.addfilestate(rel_file, *state)
+
+    def scanall(self, resume=False):
+        """
+        Полное сканирование библиотеки. При resume продолжается прерванное сканирование:
+        файлы, состояние которых уже записано, пропускаются без обращения к БД,
+        архив из отметки разбирается с книги, следующей за отмеченной, а прочие
+        архивы разбираются по книгам, даже если их каталог уже есть в БД
+
+        """
+        checkpoint = self.db.getcheckpoint('scanall') if resume else None
+        if checkpoint is None:
+            done = {}
+            self.db.clearfilestates()
+            self.db.setcheckpoint('scanall')
+        else:
+            done = self.db.getfilestates()
+            if VERBOSE:
+                print('Resume scan after: {:s} {:s}'.format(*checkpoint))
+        self.checkpoints = True
+        walker = scantree(self.cfg.ROOT_LIB, self.islibfile, self.cfg.WALK_THREADS, self.walkerror)
+        for full_path, entries in STATS.walk(walker):
+            for entry in entries:
+                filename = entry.name
+                file_path = entry.path
+                rel_file = os.path.relpath(file_path, self.cfg.ROOT_LIB)
+                if rel_file in done:
+                    STATS.count('skipped')
+                    continue
+                if VERBOSE and self.iszip(filename):
+                    print('Add file: {:s} {:s}'.format(full_path, filename))
+                if checkpoint and self.iszip(filename):
+                    member = checkpoint[1] if rel_file == checkpoint[0] else None
+                    self.processzip(full_path, filename, self.resumemembers(file_path, member))
+                    STATS.count('files')
+                elif not self.process(full_path, filename):
+                    continue
+                self.savestate(full_path, filename, entrystate(entry))
+                self.checkpoint(rel_file)
+        self.endcheckpoints()
+
+    @staticmethod
+    def resumemembers(file_path, member):
+        with zipfile.ZipFile(file_path, 'r', allowZip64=True) as z:
+            names = z.namelist()
+        if member in names:
+            return names[names.index(member) + 1:]
+        return names
+
+    def scanlast(self, path=None):
+        """
+        Инкрементальное сканирование всей библиотеки или каталога path:
+        дерево каталогов сравнивается с сохранённым состоянием файлов
+
+        """
+        checkroot(self.cfg.ROOT_LIB)
+        path = path or self.cfg.ROOT_LIB
+        rel_path = os.path.relpath(path, self.cfg.ROOT_LIB)
+        with STATS.stage('lookup'):
+            file_states = self.db.getfilestates(None if rel_path == '.' else rel_path)
+        failed = []
+
+        def onerror(e):
+            self.walkerror(e)
+            failed.append(os.path.relpath(e.filename, self.cfg.ROOT_LIB))
+
+        for full_path, entries in STATS.walk(scantree(path, self.islibfile, self.cfg.WALK_THREADS, onerror)):
+            for entry in entries:
+                rel_file = os.path.relpath(entry.path, self.cfg.ROOT_LIB)
+                self.update(full_path, entry.name, file_states.pop(rel_file, None), entrystate(entry))
+        # файлы в непрочитанных каталогах не считаются удалёнными
+        for rel_file in file_states:
+            if not any(isunder(rel_file, rel_failed) for rel_failed in failed):
+                self.remove(rel_file)
+
+    @staticmethod
+    def walkerror(e):
+        STATS.count('errors')
+        print('Error reading {:s}: {:s}'.format(str(e.filename), e.strerror or str(e)))
+
+    def update(self, path, filename, old_state, state=None):
+        if not self.islibfile(filename):
+            return
+        file_path = os.path.join(path, filename)
+        rel_file = os.path.relpath(file_path, self.cfg.ROOT_LIB)
+        state = state or filestate(file_path)
+        if old_state == state:
+            return
+        if old_state is not None:
+            if VERBOSE:
+                print('Changed file: {:s}'.format(rel_file))
+            if self.iszip(filename):
+                self.updatezip(path, filename, state)
+                return
+            self.db.delfile(rel_file)
+        if VERBOSE:
+            print('Add file: {:s} {:s}'.format(path, filename))
+        self.process(path, filename)
+        self.savestate(path, filename, state)
+
+    def updatezip(self, path, filename, state):
+        """
+        Изменившийся архив: разбираются только новые и изменённые книги,
+        книги, исчезнувшие из архива, удаляются
+
+        """
+        file_path = os.path.join(path, filename)
+        rel_file = os.path.relpath(file_path, self.cfg.ROOT_LIB)
+        members = zipmembers(file_path)
+        if zipdigest(members) != self.db.getfiledigest(rel_file):
+            old_members = self.db.getzipmembers(rel_file)
+            changed = [name for (name, crc, size) in members if old_members.pop(name, None) != (crc, size)]
+            deleted = self.db.delzipbooks(rel_file, changed + list(old_members))
+            if VERBOSE:
+                print('Update ZIP archive: {:s}, {:d} changed or new, {:d} removed'.format(rel_file, len(changed),
+                                                                                          deleted))
+            self.processzip(path, filename, changed)
+        self.db.delfilestate(rel_file)
+        self.addzipstate(rel_file, *state, members=members)
+
+    def remove(self, rel_file):
+        if VERBOSE:
+            print('Delete file: {:s}'.format(rel_file))
+        self.db.delfile(rel_file)
+
+    def updatepath(self, path):
+        """
+        Обработка изменившегося пути: файл добавляется или обновляется,
+        каталог пересканируется, исчезнувший файл или каталог удаляется из БД.
+        Пока корень библиотеки недоступен, события пропускаются
+
+        """
+        try:
+            checkroot(self.cfg.ROOT_LIB)
+        except OSError as e:
+            print('Skip changed path {:s}: {:s}'.format(path, str(e)))
+            return
+        if os.path.isdir(path):
+            self.scanlast(path)
+        elif os.path.isfile(path):
+            rel_file = os.path.relpath(path, self.cfg.ROOT_LIB)
+            self.update(os.path.dirname(path), os.path.basename(path), self.db.getfilestates(rel_file).get(rel_file))
+        else:
+            for rel_file in self.db.getfilestates(os.path.relpath(path, self.cfg.ROOT_LIB)):
+                self.remove(rel_file)
+
+    def watch(self, watcher):
+        """
+        Непрерывная индексация: события файловой системы накапливаются, и путь
+        обрабатывается, когда по нему WATCH_DELAY секунд не было новых событий
+
+        """
+        pending = {}
+        while True:
+            timeout = self.cfg.WATCH_DELAY if pending else None
+            for path in watcher.read(timeout):
+                pending[path] = time.time()
+            now = time.time()
+            ready = [path for path in pending if now - pending[path] >= self.cfg.WATCH_DELAY]
+            for path in ready[:WATCH_BATCH]:
+                del pending[path]
+                if VERBOSE:
+                    print('Changed path: {:s}'.format(path))
+                self.updatepath(path)
+            if ready:
+                self.flush()
+
+
+class ScanPool(Scanner):
+
+    TASKS_PER_JOB = 64
+
+    def __init__(self, db, cfg, jobs, covers=True):
+        # процессы создаются до потоков CoverPool: fork процесса с работающими потоками
+        # может оставить в дочернем процессе захваченные ими блокировки
+        self.pool = multiprocessing.Pool(jobs, initializer=initworker, initargs=(cfg.filename,))
+        Scanner.__init__(self, db, cfg, covers)
+        self.chunk = jobs * self.TASKS_PER_JOB
+        self.tasks = []
+        self.deferred = []
+
+    def processzip(self, path, zip_filename, members=None):
+        path_file = os.path.join(path, zip_filename)
+        rel_file = os.path.relpath(path_file, self.cfg.ROOT_LIB)
+        with STATS.stage('lookup'):
+            scanned = members is None and not self.cfg.ZIPRESCAN and self.db.zipisscanned(rel_file) != 0
+        if not scanned:
+            if members is None:
+                with STATS.stage('zip'):
+                    z = zipfile.ZipFile(path_file, 'r', allowZip64=True)
+                    file_list = z.namelist()
+                    z.close()
+            else:
+                file_list = members
+            STATS.count('zips')
+            if VERBOSE:
+                print('Start process ZIPped file: {:s}'.format(zip_filename))
+            for filename in file_list:
+                self.addtask(path_file, filename, True)
+        else:
+            STATS.count('skipped')
+            if VERBOSE:
+                print('Skip ZIP archive: ', rel_file, '. Already scanned.')
+
+    def processfile(self, path, filename):
+        self.addtask(path, filename, False)
+
+    # состояние файла записывается только после того, как записаны его книги
+    def addfilestate(self, path, size, mtime, inode):
+        self.deferred.append((Scanner.addfilestate, (self, path, size, mtime, inode)))
+
+    def addzipstate(self, path, size, mtime, inode, members):
+        self.deferred.append((Scanner.addzipstate, (self, path, size, mtime, inode, members)))
+
+    def checkpoint(self, path, member=''):
+        self.deferred.append((Scanner.checkpoint, (self, path, member)))
+
+    def endcheckpoints(self):
+        self.deferred.append((Scanner.endcheckpoints, (self,)))
+
+    def addtask(self, path, filename, in_zip):
+        rel_path = os.path.relpath(path, self.cfg.ROOT_LIB)
+        with STATS.stage('lookup'):
+            book = self.db.findbook(filename, rel_path)
+        if book:
+            STATS.count('skipped')
+            if VERBOSE:
+                print('Skip file: ', filename, '. Already scanned.')
+            return
+        self.tasks.append((path, filename, in_zip))
+        if len(self.tasks) >= self.chunk:
+            self.runtasks()
+
+    def runtasks(self):
+        tasks, self.tasks = self.tasks, []
+        for (path, filename, in_zip), fb, file_size, error, elapsed in self.pool.imap(parsetask, tasks, 8):
+            STATS.addtime('parse', elapsed)
+            if in_zip:
+                try:
+                    if error:
+                        raise error
+                    storebook(self.db, path, filename, self.cfg, fb, file_size, 1, self.covers)
+                except:
+                    STATS.count('errors')
+                    print('Error processing zip archive:', os.path.basename(path), ' file: ', filename)
+                Scanner.checkpoint(self, os.path.relpath(path, self.cfg.ROOT_LIB), filename)
+            else:
+                if error:
+                    raise error
+                storebook(self.db, path, filename, self.cfg, fb, file_size, 0, self.covers)
+        deferred, self.deferred = self.deferred, []
+        for func, args in deferred:
+            func(*args)
+
+    def flush(self):
+        self.runtasks()
+        Scanner.flush(self)
+
+    def close(self):
+        try:
+            self.runtasks()
+            Scanner.close(self)
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
 if __name__ == '__main__':
     import argparse
 
+    import watch
+
     parser = argparse.ArgumentParser(
         description='Simple OPDS Scaner - program for scan your e-book directory and store data to database.')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-i', '--init', help='Init library database', action='store_true')
     group.add_argument('-s', '--scan-all', help='Full rescan all library', action='store_true')
-    group.add_argument('-l', '--last', help='Scan files from date after last scan', action='store_true')
+    group.add_argument('-l', '--last', help='Scan new and changed files, remove deleted ones', action='store_true')
+    group.add_argument('-w', '--watch', help='Watch library directory and index changes continuously',
+                       action='store_true')
+    group.add_argument('-d', '--dedup', help='Recompute duplicates for the whole library', action='store_true')
+    group.add_argument('--rebuild-stats', help='Recompute counters, letter navigation and search index',
+                       action='store_true')
     parser.add_argument('-v', '--verbose', help='Enable verbose output', action='store_true')
     parser.add_argument('-c', '--config', help='Config file path')
+    parser.add_argument('-j', '--jobs', help='Number of processes for parsing books', type=int, default=1)
+    parser.add_argument('--resume', help='Continue interrupted full rescan (with -s)', action='store_true')
+    parser.add_argument('-r', '--report', help='Write scan statistics to JSON file')
+    parser.add_argument('-p', '--progress', help='Seconds between progress lines, 0 - no progress',
+                        type=float, default=PROGRESS_INTERVAL)
 
     args = parser.parse_args()
     VERBOSE = args.verbose
 
     if VERBOSE:
-        print('Option set: init = %s, scan-all = %s, scan-last = %s, config path = %s' % (args.init, args.scan_all, args.last, args.config))
+        print('Option set: init = %s, scan-all = %s, scan-last = %s, watch = %s, config path = %s' %
+              (args.init, args.scan_all, args.last, args.watch, args.config))
 
     if args.config and os.path.isfile(args.config):
         cfg = CfgReader(args.config)
@@ -247,6 +1088,8 @@ if __name__ == '__main__':
 
     if VERBOSE:
         print(dbase.print_db_err())
+    if not args.init:
+        dbase.create_tables()
 
     if cfg.COVER_EXTRACT:
         if not os.path.isdir(cfg.COVER_PATH):
@@ -254,35 +1097,73 @@ if __name__ == '__main__':
         if not os.path.isdir(os.path.join(cfg.COVER_PATH, 'thumbnails')):
             os.mkdir(os.path.join(cfg.COVER_PATH, 'thumbnails'))
 
-    ext_set = {x for x in cfg.EXT_LIST}
     if VERBOSE:
-        print(ext_set)
-
-    if args.init:
-        dbase.init_db()
-    elif args.scan_all:
-        for full_path, dirs, files in os.walk(cfg.ROOT_LIB):
-            for filename in files:
-                ext = os.path.splitext(filename)[1].lower()
-                if ext == '.zip' and cfg.ZIPSCAN:
-                    if VERBOSE:
-                        print('Add file: {:s} {:s}'.format(full_path, filename))
-                    processzip(dbase, full_path, filename, cfg)
-                elif ext in ext_set:
-                    processfile(dbase, full_path, filename, cfg)
-        cfg.set_last_update()
-    elif args.last:
-        for full_path, dirs, files in os.walk(cfg.ROOT_LIB):
-            for filename in files:
-                ext = os.path.splitext(filename)[1].lower()
-                mod_time = os.path.getmtime(os.path.join(full_path, filename))
-                if cfg.LAST_SCAN < mod_time:
-                    if ext == '.zip' and cfg.ZIPSCAN:
-                        processzip(dbase, full_path, filename, cfg)
-                    elif ext in ext_set:
-                        if VERBOSE:
-                            print('Add file: {:s} {:s}'.format(full_path, filename))
-                        processfile(dbase, full_path, filename, cfg)
-        cfg.set_last_update()
+        print(set(cfg.EXT_LIST))
+
+    if args.scan_all or args.last or args.watch:
+        try:
+            checkroot(cfg.ROOT_LIB)
+        except OSError as e:
+            print('Library is not accessible: {:s}'.format(str(e)))
+            sys.exit(1)
+
+    if not args.init and cfg.BATCH_SIZE > 0:
+        dbase.begin_batch(cfg.BATCH_SIZE)
+    if not args.init and cfg.CACHE_SIZE > 0:
+        dbase.load_cache(cfg.CACHE_SIZE)
 
+    STATS.interval = args.progress
+    STATS.reset()
+    # обложки извлекаются и книги разбираются в процессах только при сканировании
+    scanning = args.scan_all or args.last or args.watch
+    if args.jobs > 1 and scanning:
+        scanner = ScanPool(dbase, cfg, args.jobs)
+    else:
+        scanner = Scanner(dbase, cfg, scanning)
+
+    try:
+        if args.init:
+            dbase.init_db()
+        elif args.scan_all:
+            scanner.scanall(args.resume)
+        elif args.last:
+            scanner.scanlast()
+        elif args.watch:
+            watcher = watch.make_watcher(cfg.ROOT_LIB, cfg.WATCH_INTERVAL)
+            if VERBOSE:
+                print('Watching {:s} with {:s}'.format(cfg.ROOT_LIB, watcher.__class__.__name__))
+            scanner.scanlast()
+            scanner.flush()
+            try:
+                scanner.watch(watcher)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                watcher.close()
+        elif args.dedup:
+            count = dbase.rededup(cfg.DUBLICATES_HASH)
+            if VERBOSE:
+                print('Duplicate flags changed: {:d}'.format(count))
+        elif args.rebuild_stats:
+            dbase.rebuildcounters()
+            dbase.rebuildsearch()
+            if VERBOSE:
+                print('Books: {:d}, authors: {:d}, catalogs: {:d}'.format(*dbase.getdbinfo()))
+    finally:
+        scanner.close()
+
+    if args.scan_all or args.last:
+        cfg.set_last_update()
     dbase.close_db()
+
+    if args.scan_all or args.last or args.watch:
+        report = STATS.report()
+        print('Scan finished in {:.1f}s: {:d} files, {:d} books ({:.1f}/s, {:.2f} MB/s), '
+              '{:d} skipped, {:d} errors'.format(
+            report['elapsed'], report['counts']['files'], report['counts']['books'], report['books_per_sec'],
+            report['mb_per_sec'], report['counts']['skipped'], report['counts']['errors']))
+        if VERBOSE:
+            print('Stage times: ' + ', '.join('{:s} {:.2f}s'.format(name, report['times'][name])
+                                              for name in ScanStats.STAGES))
+    if args.report:
+        STATS.save(args.report)
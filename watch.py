@@ -0,0 +1,135 @@
+__author__ = 'vseklecov'
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+##########################################################################
+# Отслеживание изменений в каталоге библиотеки.
+# read(timeout) возвращает список изменившихся путей (файлов или каталогов);
+# путь самого корня означает "нужно пересканировать всё дерево".
+#
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Отслеживание через inotify (Linux), привязка к libc через ctypes.
+    Каталоги отслеживаются рекурсивно, новые каталоги добавляются по мере появления.
+
+    """
+    def __init__(self, root):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+        self.libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.root = root
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno()
+        self.watches = {}
+        self.addtree(root)
+
+    def raise_errno(self, path=None):
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+
+    def addwatch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return
+            self.raise_errno(path)
+        self.watches[wd] = path
+
+    def addtree(self, path):
+        for full_path, dirs, files in os.walk(path):
+            self.addwatch(full_path)
+
+    def read(self, timeout=None):
+        paths = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return paths
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return paths
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                paths.append(self.root)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.addtree(path)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollWatcher:
+    """
+    Запасной вариант без inotify: раз в interval секунд сообщает о корне библиотеки,
+    т.е. запрашивает инкрементальное пересканирование всего дерева.
+
+    """
+    def __init__(self, root, interval=60):
+        self.root = root
+        self.interval = interval
+        self.next_poll = time.time() + interval
+
+    def read(self, timeout=None):
+        delay = self.next_poll - time.time()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(delay, 0))
+        self.next_poll = time.time() + self.interval
+        return [self.root]
+
+    def close(self):
+        pass
+
+
+def make_watcher(root, interval=60):
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError):
+        return PollWatcher(root, interval)